@@ -0,0 +1,160 @@
+"""
+Layout of a HiLLoC archive file:
+
+    MAGIC | payload: uint32 words of all chains | header: utf-8 JSON | footer
+
+The footer holds the byte offset and length of the header followed by MAGIC again, so that the
+header can be found from the end of the file. The header describes each chain as a list of
+[offset, length] segments of the payload in words, next to what is needed to rebuild the codecs
+(see compression.py). The flattened message of a chain is the concatenation of its segments in
+reverse: segments are stored bottom of the stack first, the last one starting with the head.
+Keeping the header after the payload lets the payload be written before the layout is complete.
+Appending to an archive writes new segments over the old header and footer, followed by a new
+header, so that the file grows by the new words and the difference in header size.
+"""
+import json
+import struct
+
+import numpy as np
+
+MAGIC = b'HILLOC\x00\x01'
+footer_format = '<QQ8s'
+footer_size = struct.calcsize(footer_format)
+word = np.dtype('<u4')
+
+
+def pack_chains(flat_messages):
+    """
+    Concatenates the flattened messages of independent bits-back chains into a single uint32 array,
+    prefixed by a chain index: the number of chains followed by the length of each chain.
+    """
+    index = np.array([len(flat_messages)] + [len(m) for m in flat_messages], dtype=np.uint32)
+    return np.concatenate([index] + [np.asarray(m, dtype=np.uint32) for m in flat_messages])
+
+
+def unpack_chains(words):
+    """Inverse of pack_chains, returns views into words."""
+    n_chains = int(words[0])
+    lengths = words[1:n_chains + 1].astype(np.int64)
+    offsets = n_chains + 1 + np.concatenate([[0], np.cumsum(lengths)])
+    return [words[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+
+
+class ArchiveWriter:
+    """Writes the payload of an archive segment by segment, then its header."""
+
+    def __init__(self, path, append=False):
+        """
+        With append, words are written after the payload of an existing archive at path, over its
+        header and footer. These are kept in memory, and written back on exit if finish is not
+        reached, so an append that fails with an exception leaves the archive as it was.
+        """
+        self.path = str(path)
+        self.finished = False
+        self.old_end = None
+        if append:
+            _, header_offset = read_header(self.path)
+            self.file = open(self.path, 'r+b')
+            self.file.seek(header_offset)
+            self.old_end = header_offset, self.file.read()
+            self.file.seek(header_offset)
+            self.n_words = (header_offset - len(MAGIC)) // word.itemsize
+        else:
+            self.file = open(self.path, 'wb')
+            self.file.write(MAGIC)
+            self.n_words = 0
+
+    def write_segment(self, words):
+        """Appends words to the payload, returns their [offset, length] in words."""
+        words = np.ascontiguousarray(words, dtype=word)
+        words.tofile(self.file)
+        segment = [self.n_words, len(words)]
+        self.n_words += len(words)
+        return segment
+
+    def map_segment(self, segment):
+        """Read-only memory map of a segment that was written."""
+        self.file.flush()
+        offset, length = segment
+        return np.memmap(self.path, dtype=word, mode='r', offset=len(MAGIC) + word.itemsize * offset,
+                         shape=(length,))
+
+    def finish(self, header):
+        _write_header(self.file, header)
+        self.file.close()
+        self.finished = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        if not self.finished and self.old_end is not None:
+            header_offset, old_end = self.old_end
+            self.file.seek(header_offset)
+            self.file.write(old_end)
+            self.file.truncate()
+        self.file.close()
+
+
+def chain_positions(layout):
+    """
+    Positions of the images of a chain in the order it was encoded in, in the order they are
+    popped: the parts appended last first, each in the order of its layout, then the bootstrap
+    images.
+    """
+    parts = [layout] + layout.get('appended', [])
+    first_positions = np.cumsum([layout['n_bootstrap']] + [len(part['order']) for part in parts])
+    positions = [int(first + i) for part, first in reversed(list(zip(parts, first_positions)))
+                 for i in part['order']]
+    return positions + list(range(layout['n_bootstrap']))
+
+
+def write_archive(path, header, flat_messages, layouts):
+    """Writes flat_messages with header (a JSON serialisable dict) to an archive file at path, each
+    as a chain of a single segment. The segments and layout of each chain are added to
+    header['chains']."""
+    header = dict(header, chains=[])
+    with ArchiveWriter(path) as writer:
+        for flat_message, layout in zip(flat_messages, layouts):
+            header['chains'].append(dict(segments=[writer.write_segment(flat_message)], layout=layout))
+        writer.finish(header)
+    return header
+
+
+def _write_header(f, header):
+    header_offset = f.tell()
+    header_bytes = json.dumps(header).encode('utf-8')
+    f.write(header_bytes)
+    f.write(struct.pack(footer_format, header_offset, len(header_bytes), MAGIC))
+    f.truncate()
+
+
+def read_header(path):
+    with open(str(path), 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a HiLLoC archive")
+        f.seek(-footer_size, 2)
+        header_offset, header_length, magic = struct.unpack(footer_format, f.read(footer_size))
+        if magic != MAGIC:
+            raise ValueError(f"{path} is truncated or not a HiLLoC archive")
+        f.seek(header_offset)
+        return json.loads(f.read(header_length).decode('utf-8')), header_offset
+
+
+def read_archive(path):
+    """
+    Returns the header of the archive at path and the segments of each of its chains, as read-only
+    views into a memory map of the payload. Nothing is read from the payload until the words are
+    accessed.
+    """
+    header, header_offset = read_header(path)
+    n_words = (header_offset - len(MAGIC)) // word.itemsize
+    payload = np.memmap(str(path), dtype=word, mode='r', offset=len(MAGIC), shape=(n_words,)) \
+        if n_words else np.zeros(0, word)
+    return header, [[payload[offset:offset + length] for offset, length in chain['segments']]
+                    for chain in header['chains']]
+
+
+def read_chain(path, index):
+    header, chains = read_archive(path)
+    return header['chains'][index], chains[index]
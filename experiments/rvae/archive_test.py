@@ -0,0 +1,67 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from rvae.archive import ArchiveWriter, MAGIC, chain_positions, footer_size, read_archive, read_header, \
+    write_archive
+
+
+class ArchiveTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'archive.hlc')
+        self.header = write_archive(self.path, dict(image_count=1),
+                                    [np.arange(5, dtype=np.uint32)], [dict(n_bootstrap=0)])
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def append(self, words):
+        with ArchiveWriter(self.path, append=True) as writer:
+            segment = writer.write_segment(words)
+            self.header['chains'][0]['segments'].append(segment)
+            writer.finish(self.header)
+
+    def test_append(self):
+        self.append(np.arange(3, dtype=np.uint32))
+        header, (segments,) = read_archive(self.path)
+        self.assertEqual(header, self.header)
+        np.testing.assert_equal(np.concatenate(segments), [0, 1, 2, 3, 4, 0, 1, 2])
+
+    def test_append_overwrites_old_header(self):
+        self.append(np.arange(3, dtype=np.uint32))
+        self.append(np.arange(2, dtype=np.uint32))
+        header_bytes = len(json.dumps(self.header).encode('utf-8'))
+        self.assertEqual(os.path.getsize(self.path), len(MAGIC) + 4 * 10 + header_bytes + footer_size)
+        _, (segments,) = read_archive(self.path)
+        np.testing.assert_equal(np.concatenate(segments), [0, 1, 2, 3, 4, 0, 1, 2, 0, 1])
+
+    def test_failed_append_leaves_archive_intact(self):
+        with open(self.path, 'rb') as f:
+            contents = f.read()
+        with self.assertRaises(RuntimeError):
+            with ArchiveWriter(self.path, append=True) as writer:
+                writer.write_segment(np.arange(300, dtype=np.uint32))
+                raise RuntimeError
+        with open(self.path, 'rb') as f:
+            self.assertEqual(f.read(), contents)
+        self.assertEqual(read_header(self.path)[0], self.header)
+
+
+class ChainPositionsTestCase(unittest.TestCase):
+    def test_appended_parts(self):
+        # 2 bootstrap images, 3 images batched out of order, then appended parts of 2 and 3 images
+        layout = dict(n_bootstrap=2, order=[1, 2, 0],
+                      appended=[dict(order=[1, 0]), dict(order=[2, 1, 0])])
+        positions = chain_positions(layout)
+        self.assertEqual(positions, [9, 8, 7, 6, 5, 3, 4, 2, 0, 1])
+        # the newest k images, for k spanning several parts
+        self.assertEqual(sorted(positions[:4]), [6, 7, 8, 9])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,8 +1,11 @@
 import os
+import time
 from collections import defaultdict
 
+import craystack as cs
 import numpy as np
 
+from rvae.bytes_codec import bytes_codec
 from rvae.datasets import scale_down_and_round_even
 
 
@@ -40,3 +43,43 @@ def benchmark(image_paths, formats=('ppm', 'png', 'jp2', 'webp'), max_pixels=Non
         channels = np.sum(all_channels[format])
         size = np.sum(all_sizes[format])
         print_summary(format, channels, size)
+
+
+def per_byte_codec():
+    """The bootstrap byte codec before bytes_codec: one cs.Uniform(8) push per byte."""
+    byte_codec = cs.Uniform(8)
+    len_codec = cs.Uniform(31)
+
+    def push(message, data):
+        message = cs.repeat(byte_codec, len(data)).push(message, list(data))
+        return len_codec.push(message, np.uint64(len(data)))
+
+    def pop(message):
+        message, n_bytes = len_codec.pop(message)
+        message, data = cs.repeat(byte_codec, n_bytes[0]).pop(message)
+        return message, bytes(np.squeeze(data).astype(np.uint8))
+
+    return cs.Codec(push, pop)
+
+
+def benchmark_byte_codecs(sizes=(10 ** 4, 10 ** 5, 5 * 10 ** 5), repeats=3, seed=0):
+    """Push and pop time of random byte strings with per_byte_codec and bytes_codec."""
+    rng = np.random.RandomState(seed)
+    codecs = {'per byte': per_byte_codec(), 'bytes_codec': bytes_codec()}
+
+    print('size/bytes, codec, push/ms, pop/ms, message size/bytes')
+    for size in sizes:
+        data = rng.randint(256, size=size, dtype=np.uint8).tobytes()
+        for name, codec in codecs.items():
+            push_time, pop_time = 0., 0.
+            for _ in range(repeats):
+                t0 = time.time()
+                message = codec.push(cs.empty_message((1,)), data)
+                push_time += time.time() - t0
+                message_size = 4 * len(cs.flatten(message))
+                t0 = time.time()
+                message, decoded = codec.pop(message)
+                pop_time += time.time() - t0
+                assert decoded == data
+            print(f'{size}, {name}, {push_time / repeats * 1000:.1f}, {pop_time / repeats * 1000:.1f}, '
+                  f'{message_size}')
@@ -0,0 +1,72 @@
+"""
+Lossless codecs for the first images of a bits-back chain, which start its message. FLIF runs the
+flif binary in a subprocess, PNG and WebP are coded in process by OpenCV. Both release the GIL, so
+the images of a bootstrap are compressed and decompressed in parallel on a thread pool, and only
+pushing and popping their bytes is serial.
+"""
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import craystack as cs
+import numpy as np
+
+from rvae.bytes_codec import bytes_codec, compressed_image_codec
+from rvae.flif import FLIF_COMPRESSOR
+from rvae.lossless import PNG_COMPRESSOR, WEBP_COMPRESSOR
+
+bootstrap_compressors = {'flif': FLIF_COMPRESSOR, 'png': PNG_COMPRESSOR, 'webp': WEBP_COMPRESSOR}
+codec = bytes_codec()
+
+
+def bootstrap_compressor(name):
+    if name not in bootstrap_compressors:
+        raise ValueError(f"Unknown bootstrap codec {name}, expected one of {', '.join(bootstrap_compressors)}")
+    return bootstrap_compressors[name]
+
+
+def bootstrap_codec(name):
+    """Codec for a single chw image, as coded by push_bootstrap."""
+    return compressed_image_codec(bootstrap_compressor(name))
+
+
+def bootstrap_executor(threads=0):
+    """Thread pool for compressing bootstrap images, of threads threads or the default number if 0."""
+    return ThreadPoolExecutor(threads or None)
+
+
+def compress_bootstrap(name, images, executor):
+    """
+    Starts compressing a list of image batches of one image on executor and returns futures of
+    their bytes, so that the caller can do something else (e.g. build the VAE codecs) meanwhile.
+    """
+    return [executor.submit(bootstrap_compressor(name).compress, image[0]) for image in images]
+
+
+def push_bootstrap(name, message, images, compressed):
+    """
+    Pushes a list of image batches of one image with the bootstrap codec name, given futures of
+    their bytes from compress_bootstrap, and reports the time spent waiting for them and pushing,
+    and the rate. Pushes the same as cs.repeat(cs.repeat(bootstrap_codec(name), 1), len(images)).
+    """
+    t0 = time.time()
+    start_words = len(cs.flatten(message))
+    for image_bytes in reversed(compressed):
+        message = codec.push(message, image_bytes.result())
+    dims = np.sum([image.size for image in images])
+    print(f"Bootstrap with {name}: {len(images)} images in {time.time() - t0:.2f}s, "
+          f"{32 * (len(cs.flatten(message)) - start_words) / dims:.4f} bits per dim")
+    return message
+
+
+def pop_bootstrap(name, message, n_images, executor):
+    """
+    Inverse of push_bootstrap. Pops the bytes of all images, then starts decompressing them in
+    parallel on executor. Returns the message and futures of the chw images.
+    """
+    compressed = []
+    for _ in range(n_images):
+        message, image_bytes = codec.pop(message)
+        compressed.append(image_bytes)
+    return message, [executor.submit(bootstrap_compressor(name).decompress, image_bytes)
+                     for image_bytes in compressed]
@@ -0,0 +1,60 @@
+from collections import namedtuple
+
+import craystack as cs
+import numpy as np
+
+# functions from an image to a byte string, and back
+Compressor = namedtuple('Compressor', ['compress', 'decompress'])
+
+
+def bytes_codec(len_codec=cs.Uniform(31)):
+    """
+    Codec for byte strings such as compressed files, which are packed into uint32 words and put on
+    the tail of the message as a single node, without going through the head, followed by their
+    length. Pushing words to the tail is equivalent to pushing them with cs.Uniform(32), so the
+    words can be consumed by later pops like any others.
+    """
+    def push(message, data):
+        n_bytes = len(data)
+        padded = data + bytes(-n_bytes % 4)
+        if n_bytes:
+            head, tail = message
+            message = head, (np.frombuffer(padded, dtype='<u4').astype(np.uint32), tail)
+        return len_codec.push(message, np.uint64(n_bytes))
+
+    def pop(message):
+        message, n_bytes = len_codec.pop(message)
+        n_bytes = int(np.array(n_bytes).ravel()[0])
+        head, tail = message
+        tail, words = tail_slice(tail, -(-n_bytes // 4))
+        return (head, tail), words.astype('<u4').tobytes()[:n_bytes]
+
+    return cs.Codec(push, pop)
+
+
+def tail_slice(tail, n):
+    """The rest of a tail after its top n words, and those words, unpacking as few nodes as possible."""
+    words = []
+    while n > 0:
+        node, tail = tail
+        if n < len(node):
+            words.append(node[:n])
+            tail = node[n:], tail
+            break
+        words.append(node)
+        n -= len(node)
+    return tail, np.concatenate(words) if words else np.zeros(0, np.uint32)
+
+
+def compressed_image_codec(compressor):
+    """Codec for images compressed to byte strings by a Compressor, coded with bytes_codec."""
+    codec = bytes_codec()
+
+    def push(message, image):
+        return codec.push(message, compressor.compress(image))
+
+    def pop(message):
+        message, compressed_bytes = codec.pop(message)
+        return message, compressor.decompress(compressed_bytes)
+
+    return cs.Codec(push, pop)
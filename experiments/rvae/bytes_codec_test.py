@@ -0,0 +1,55 @@
+import unittest
+
+import craystack as cs
+import numpy as np
+
+from rvae.bytes_codec import bytes_codec, tail_slice
+
+
+class BytesCodecTestCase(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.strings = [rng.bytes(n) for n in (0, 1, 3, 5, 1001)]
+        self.message = cs.random_message(16, (1,))
+        self.codec = bytes_codec()
+
+    def assert_same_message(self, message, other):
+        np.testing.assert_array_equal(cs.flatten(message), cs.flatten(other))
+
+    def test_round_trip(self):
+        for data in self.strings:
+            rest, decoded = self.codec.pop(self.codec.push(self.message, data))
+            self.assertEqual(decoded, data)
+            self.assert_same_message(rest, self.message)
+
+    def test_several_strings(self):
+        message = self.message
+        for data in self.strings:
+            message = self.codec.push(message, data)
+        decoded = []
+        for _ in self.strings:
+            message, data = self.codec.pop(message)
+            decoded.append(data)
+        self.assertEqual(decoded, self.strings[::-1])
+        self.assert_same_message(message, self.message)
+
+    def test_tail_slice(self):
+        tail = np.arange(3, dtype=np.uint32), (np.arange(3, 8, dtype=np.uint32), ())
+        rest, words = tail_slice(tail, 5)
+        np.testing.assert_array_equal(words, np.arange(5))
+        # the second node is split, its last words stay on the tail
+        node, below = rest
+        np.testing.assert_array_equal(node, [5, 6, 7])
+        self.assertEqual(below, ())
+
+        rest, words = tail_slice(tail, 8)
+        np.testing.assert_array_equal(words, np.arange(8))
+        self.assertEqual(rest, ())
+
+        rest, words = tail_slice(tail, 0)
+        self.assertEqual(len(words), 0)
+        self.assertIs(rest, tail)
+
+
+if __name__ == '__main__':
+    unittest.main()
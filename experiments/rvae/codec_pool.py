@@ -0,0 +1,103 @@
+import threading
+from collections import OrderedDict, Counter
+
+
+class CodecPool:
+    """
+    Least recently used pool of shape-specialised codecs.
+
+    Codecs are built on demand by build(shape), which returns a pair (codec, resource). The resource
+    (e.g. the tf.Session backing the codec) is handed to release when the codec is evicted. At most
+    max_codecs codecs are resident, and if memory_budget is given, the summed size_of(shape)
+    estimates of resident codecs are kept below it (a single codec larger than the budget is still
+    built, after evicting everything else). Pinned codecs are not evicted, so that they can be used
+    from other threads.
+    """
+
+    def __init__(self, build, release=None, max_codecs=4, memory_budget=None, size_of=None):
+        assert max_codecs >= 1
+        self.build = build
+        self.release = release
+        self.max_codecs = max_codecs
+        self.memory_budget = memory_budget
+        self.size_of = size_of if size_of is not None else (lambda shape: 0)
+
+        self._codecs = OrderedDict()  # shape -> (codec, resource, size), least recently used first
+        self._pins = Counter()
+        self._lock = threading.RLock()
+        self.used_memory = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __call__(self, shape):
+        shape = _shape_key(shape)
+        with self._lock:
+            if shape in self._codecs:
+                self.hits += 1
+                self._codecs.move_to_end(shape)
+                return self._codecs[shape][0]
+
+            self.misses += 1
+            size = self.size_of(shape)
+            while self._evictable() and (len(self._codecs) >= self.max_codecs or self._over_budget(size)):
+                self.evict()
+
+            codec, resource = self.build(shape)
+            self._codecs[shape] = codec, resource, size
+            self.used_memory += size
+            return codec
+
+    def pin(self, shape):
+        """Protects the codec for shape from eviction, returns False if it is not resident."""
+        shape = _shape_key(shape)
+        with self._lock:
+            if shape not in self._codecs:
+                return False
+            self._pins[shape] += 1
+            return True
+
+    def unpin(self, shape):
+        shape = _shape_key(shape)
+        with self._lock:
+            self._pins[shape] -= 1
+            if not self._pins[shape]:
+                del self._pins[shape]
+
+    def _evictable(self):
+        return [shape for shape in self._codecs if shape not in self._pins]
+
+    def _over_budget(self, size):
+        return self.memory_budget is not None and self.used_memory + size > self.memory_budget
+
+    def evict(self):
+        """Evicts the least recently used codec that is not pinned."""
+        with self._lock:
+            shape = self._evictable()[0]
+            print("Evicting codec for shape " + str(shape))
+            _, resource, size = self._codecs.pop(shape)
+            self.used_memory -= size
+            self.evictions += 1
+            if self.release is not None:
+                self.release(resource)
+
+    def clear(self):
+        while self._evictable():
+            self.evict()
+
+    def __len__(self):
+        return len(self._codecs)
+
+    def __contains__(self, shape):
+        return _shape_key(shape) in self._codecs
+
+    def report(self):
+        requests = self.hits + self.misses
+        print(f"Codec pool: {len(self)}/{self.max_codecs} resident, "
+              f"hits: {self.hits}, misses: {self.misses}, evictions: {self.evictions}, "
+              f"hit rate: {self.hits / max(requests, 1) * 100:.1f}%, "
+              f"estimated memory: {self.used_memory / 2 ** 20:.0f}MB")
+
+
+def _shape_key(shape):
+    return tuple(int(s) for s in shape)
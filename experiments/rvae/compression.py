@@ -0,0 +1,1033 @@
+import hashlib
+import multiprocessing
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from collections import OrderedDict
+from functools import lru_cache, partial
+from itertools import islice
+from pathlib import Path
+
+import craystack as cs
+import numpy as np
+import tensorflow as tf
+
+from rvae import dispatch
+from rvae.archive import ArchiveWriter, chain_positions, pack_chains, unpack_chains, read_archive, \
+    read_header, read_chain, write_archive
+from rvae.codec_pool import CodecPool
+from rvae.datasets import array_to_image_file
+from rvae.dedup import DuplicateIndex, coded_ids, references, iter_with_duplicates
+from rvae.metrics import MessageMetrics
+from rvae.bootstrap import bootstrap_executor, compress_bootstrap, pop_bootstrap, push_bootstrap
+from rvae.model import CVAE1, FLAGS
+from rvae.model.layerwise import LayerwiseCVAE, latent_from_image_shape
+from rvae.regions import crop_region
+from rvae.virtual_tail import attach_virtual_tail, detach_virtual_tail, virtual_message
+
+prior_precision = 10
+obs_precision = 24
+q_precision = 18
+
+# hparams that change the structure of the bitstream, besides the model weights
+codec_hparams = ('compression_always_variable', 'compression_exclude_sizes', 'compression_polymorphic',
+                 'flat_tiles', 'flat_max_bits', 'codec_dispatch', 'bootstrap_codec')
+
+
+@lru_cache()
+def checkpoint_weights(path):
+    """Reads all variables of a checkpoint into memory once, to be shared by all graphs."""
+    reader = tf.train.NewCheckpointReader(path)
+    return {name: reader.get_tensor(name) for name in reader.get_variable_to_shape_map()}
+
+
+def restore_from_weights(sess, var_dict, weights):
+    """Equivalent to tf.train.Saver(var_dict).restore, but from weights already in memory."""
+    sess.run([var.initializer for var in var_dict.values()],
+             feed_dict={var.initial_value: weights[name] for name, var in var_dict.items()})
+
+
+@lru_cache()
+def model_fingerprint(checkpoint):
+    """Hash of the weights of a checkpoint, to check that an archive is decoded with its model."""
+    weights = checkpoint_weights(checkpoint)
+    digest = hashlib.sha256()
+    for name in sorted(weights):
+        digest.update(name.encode('utf-8'))
+        digest.update(np.ascontiguousarray(weights[name]).tobytes())
+    return digest.hexdigest()
+
+
+def archive_header(hps, checkpoint, image_count):
+    return dict(model=model_fingerprint(checkpoint),
+                precisions=dict(prior=prior_precision, obs=obs_precision, q=q_precision),
+                hparams={name: getattr(hps, name) for name in codec_hparams},
+                image_count=int(image_count))
+
+
+def adopt_archive_header(hps, checkpoint, header):
+    """
+    Raises a ValueError if the archive was not written with the model and precisions given, and
+    sets the hparams that determine the structure of the bitstream to those the archive was written
+    with.
+    """
+    expected = archive_header(hps, checkpoint, header['image_count'])
+    for key in ('model', 'precisions'):
+        if header[key] != expected[key]:
+            raise ValueError(f"Archive was written with {key} {header[key]}, "
+                             f"but decoding with {expected[key]}")
+    for name, value in header['hparams'].items():
+        setattr(hps, name, value)
+
+
+def write_chains_archive(path, hps, checkpoint, flat_messages, layouts, **header_fields):
+    """Writes independent chains to an archive, with an index of the id of the first image of each
+    chain, so that single images can be decoded with decode_image. header_fields are added to the
+    header."""
+    image_counts = [len(layout['order']) + layout['n_bootstrap'] for layout in layouts]
+    header = dict(archive_header(hps, checkpoint, sum(image_counts)),
+                  index=[int(i) for i in np.cumsum([0] + image_counts[:-1])], **header_fields)
+    return write_archive(path, header, flat_messages, layouts)
+
+
+def batch_indices(shapes, batch_size):
+    """
+    Groups the indices of images with the given shapes into batches of batch_size images of the same
+    shape, in order of first appearance of each shape. Images that do not fill a batch of their shape
+    are put in batches of a single image, so that at most two batch sizes are in use.
+    """
+    indices_by_shape = OrderedDict()
+    for i, shape in enumerate(shapes):
+        indices_by_shape.setdefault(tuple(shape), []).append(i)
+
+    batches = []
+    for indices in indices_by_shape.values():
+        n_full = len(indices) // batch_size * batch_size
+        batches += [indices[i:i + batch_size] for i in range(0, n_full, batch_size)]
+        batches += [[i] for i in indices[n_full:]]
+    return batches
+
+
+def batch_images(images, batch_size):
+    return [np.stack([images[i] for i in indices])
+            for indices in batch_indices([image.shape for image in images], batch_size)]
+
+
+def build_layerwise_model(hps, shape, checkpoint):
+    """Builds the layerwise model for an image shape and restores its weights. Height and width can
+    be None, in which case the graph serves all image sizes."""
+    hps.batch_size = hps.eval_batch_size = shape[0]
+    hps.image_size = (shape[2], shape[3])
+
+    graph = tf.Graph()
+    with graph.as_default():
+        with tf.variable_scope("model", reuse=tf.AUTO_REUSE):
+            x = tf.placeholder(tf.float32, shape, 'x')
+            model = CVAE1(hps, "eval", x)
+            stepwise_model = LayerwiseCVAE(model)
+
+    config = tf.ConfigProto(allow_soft_placement=True,
+                            intra_op_parallelism_threads=4,
+                            inter_op_parallelism_threads=4)
+    sess = tf.Session(config=config, graph=graph)
+    restore_from_weights(sess, model.avg_dict, checkpoint_weights(checkpoint))
+    return stepwise_model, sess
+
+
+def codec_memory_estimate(hps, shape):
+    """Rough number of bytes held by a codec for the given image shape: weights plus the
+    hidden activations of all layers (up pass, down pass and contexts)."""
+    n, _, height, width = shape
+    weight_bytes = 4 * hps.num_blocks * 9 * hps.h_size * (6 * hps.z_size + 4 * hps.h_size)
+    activation_bytes = 4 * n * (height // 2) * (width // 2) * hps.num_blocks * \
+                       (6 * hps.h_size + 8 * hps.z_size)
+    return weight_bytes + activation_bytes
+
+
+class VAECodecs:
+    """Shape-specialised HiLLoC codecs of a trained model, kept resident in a CodecPool."""
+
+    def __init__(self, hps, checkpoint):
+        self.hps = hps
+        self.checkpoint = checkpoint
+        self.context_prefetcher = None
+        # called with the mean of the likelihood of each image batch when its pixels are about to be
+        # popped, see iter_decode_chain
+        self.on_preview = None
+        # chooses the codec of each image batch, if hps.flat_tiles or hps.codec_dispatch
+        self.chooser = dispatch.CodecChooser(
+            tags=dispatch.dispatch_tags() if hps.codec_dispatch else (dispatch.VAE,),
+            flat_max_bits=hps.flat_max_bits if hps.flat_tiles else None,
+            bits_per_second=hps.dispatch_bits_per_second,
+            prior_bpd={dispatch.VAE: hps.dispatch_vae_bpd, dispatch.FLIF_TAG: hps.dispatch_flif_bpd},
+            prior_seconds_per_dim={dispatch.VAE: hps.dispatch_vae_us_per_dim * 1e-6,
+                                   dispatch.FLIF_TAG: hps.dispatch_flif_us_per_dim * 1e-6,
+                                   dispatch.PNG_TAG: hps.dispatch_png_us_per_dim * 1e-6})
+
+        self._polymorphic_models = {}
+        self._up_passes = {}
+        self.codec_from_shape = CodecPool(
+            self._create_codec,
+            release=None if hps.compression_polymorphic else lambda sess: sess.close(),
+            max_codecs=hps.codec_pool_size,
+            memory_budget=hps.codec_pool_memory_mb * 2 ** 20 or None,
+            size_of=partial(codec_memory_estimate, hps))
+
+    def polymorphic_model(self, batch_size):
+        if batch_size not in self._polymorphic_models:
+            print("Creating shape-polymorphic model for batch size " + str(batch_size))
+            self._polymorphic_models[batch_size] = build_layerwise_model(
+                self.hps, (batch_size, 3, None, None), self.checkpoint)
+        return self._polymorphic_models[batch_size]
+
+    def up_pass(self, run_all_contexts, image):
+        if self.context_prefetcher is None:
+            return run_all_contexts(image)
+        return self.context_prefetcher.up_pass(run_all_contexts, image)
+
+    def skip_up_pass(self, image):
+        if self.context_prefetcher is not None:
+            self.context_prefetcher.skip(image)
+
+    def try_up_pass(self, image):
+        """Up pass on the prefetch thread, only for shapes whose codec is resident."""
+        if not self.codec_from_shape.pin(image.shape):
+            return None
+        try:
+            return self._up_passes[image.shape](image)
+        finally:
+            self.codec_from_shape.unpin(image.shape)
+
+    def _create_codec(self, shape):
+        from autograd.builtins import tuple as ag_tuple
+        from rvae.resnet_codec import ResNetVAE
+
+        print("Creating codec for shape " + str(shape))
+
+        if self.hps.compression_polymorphic:
+            stepwise_model, sess = self.polymorphic_model(shape[0])
+        else:
+            stepwise_model, sess = build_layerwise_model(self.hps, shape, self.checkpoint)
+
+        z_shape = latent_from_image_shape(self.hps)(shape)
+        z_size = np.prod(z_shape)
+
+        run_all_contexts, run_top_prior, runs_down_prior, run_top_posterior, runs_down_posterior, \
+        run_reconstruction = stepwise_model.get_model_parts_as_numpy_functions(sess, shape)
+        run_top_prior_and_posterior, runs_down_prior_and_posterior = \
+            stepwise_model.get_fused_parts_as_numpy_functions(sess)
+        self._up_passes[shape] = run_all_contexts
+
+        # Setup codecs
+        def vae_view(head):
+            return ag_tuple((np.reshape(head[:z_size], z_shape),
+                             np.reshape(head[z_size:], shape)))
+
+        def obs_codec(h, z1):
+            mean, log_scale = run_reconstruction(h, z1)
+            codec = cs.Logistic_UnifBins(mean, log_scale, obs_precision, bin_prec=8,
+                                         bin_lb=-0.5, bin_ub=0.5)
+            if self.on_preview is None:
+                return codec
+
+            def pop(message):
+                # all latents are popped at this point, the pixels are not
+                self.on_preview(preview_image(mean))
+                return codec.pop(message)
+
+            return cs.Codec(codec.push, pop)
+
+        vae_codec = cs.substack(
+            ResNetVAE(partial(self.up_pass, run_all_contexts),
+                      run_top_posterior, runs_down_posterior,
+                      run_top_prior, runs_down_prior,
+                      obs_codec, prior_precision, q_precision,
+                      run_top_prior_and_posterior, runs_down_prior_and_posterior),
+            vae_view)
+
+        return vae_codec, None if self.hps.compression_polymorphic else sess
+
+    def build_first(self, shapes):
+        """Builds the codec of the batch of shapes that is pushed first, e.g. while the bootstrap
+        images are compressed."""
+        if shapes:
+            self.codec_from_shape(shapes[-1])
+
+    def head_shape(self, shape):
+        return (np.prod(shape) + np.prod(latent_from_image_shape(self.hps)(shape)),)
+
+    def _repeated(self, shapes):
+        """Whether batches of the given shapes are all coded with the codec of a single shape."""
+        hps = self.hps
+        return not (hps.compression_always_variable or self._dispatched()) and len(set(shapes)) == 1
+
+    def _dispatched(self):
+        return self.hps.flat_tiles or self.hps.codec_dispatch
+
+    def serial_codec(self, shapes, previous_dims=0):
+        """Codec for a list of image batches of the given shapes, and the head shape it expects."""
+        hps = self.hps
+        if self._repeated(shapes):
+            return cs.repeat(self.codec_from_shape(shapes[0]), len(shapes)), self.head_shape(shapes[0])
+        if self._dispatched():
+            return self.images_codec(shapes, previous_dims), (1,)
+        if hps.compression_exclude_sizes:
+            return rvae_variable_known_size_codec(
+                codec_from_image_shape=self.codec_from_shape,
+                latent_from_image_shape=latent_from_image_shape(hps),
+                shapes=shapes,
+                previous_dims=previous_dims), (1,)
+        return rvae_variable_size_codec(self.codec_from_shape,
+                                        latent_from_image_shape=latent_from_image_shape(hps),
+                                        image_count=len(shapes),
+                                        previous_dims=previous_dims), (1,)
+
+    def batch_codecs(self, shapes):
+        """The codec serial_codec(shapes) applies to each batch, to pop the batches one at a time."""
+        if self._repeated(shapes):
+            return [self.codec_from_shape(shapes[0])] * len(shapes)
+        return [self.image_codec(shape) for shape in shapes]
+
+    def images_codec(self, shapes, previous_dims=0):
+        """Codec for a list of image batches of the given shapes, coded with image_codec."""
+        return rvae_serial_with_progress([self.image_codec(shape) for shape in shapes], previous_dims)
+
+    def image_codec(self, shape):
+        """
+        Codec for a single image batch, as coded by serial_codec for images of various shapes. With
+        hps.flat_tiles or hps.codec_dispatch, each batch is coded with the codec self.chooser
+        picks, and the choice is coded with it.
+        """
+        hps = self.hps
+        if hps.compression_exclude_sizes:
+            codec = rvae_known_size_image_codec(self.codec_from_shape, latent_from_image_shape(hps), shape)
+        else:
+            codec = rvae_variable_size_image_codec(self.codec_from_shape, latent_from_image_shape(hps))
+        if not self._dispatched():
+            return codec
+        codecs = dispatch.image_codecs(codec, hps.flat_max_bits,
+                                       shape if hps.compression_exclude_sizes else None)
+        return dispatch.dispatch_codec(codecs, self.chooser, self.skip_up_pass)
+
+    def report_choices(self):
+        """Prints the codec chosen for the batches pushed since the last report, if hps.flat_tiles
+        or hps.codec_dispatch, and resets the chooser."""
+        if self.chooser.counts:
+            self.chooser.report()
+        self.chooser.reset()
+
+    def close(self):
+        self.report_choices()
+        self.codec_from_shape.report()
+        self.codec_from_shape.clear()
+        for _, sess in self._polymorphic_models.values():
+            sess.close()
+        self._polymorphic_models.clear()
+
+
+def preview_image(mean):
+    """Pixel values of the mean of the likelihood, inverting the preprocessing of CVAE1."""
+    return np.clip(np.round((mean + 0.5) * 256. - 0.5), 0, 255).astype(np.uint8)
+
+
+def initial_message(hps, bootstrap_images, seed=None, compressed=None):
+    """Starts the bits-back chain by compressing bootstrap_images with hps.bootstrap_codec, or if
+    there are none from a virtual message of at most hps.initial_bits random words generated from
+    seed (hps.seed by default) as they are popped. See detach_virtual_tail for storing the message.
+    The bootstrap images are compressed in parallel, unless compressed (see compress_bootstrap)
+    already holds their bytes."""
+    if bootstrap_images:
+        if compressed is None:
+            with bootstrap_executor(hps.bootstrap_threads) as executor:
+                compressed = compress_bootstrap(hps.bootstrap_codec, bootstrap_images, executor)
+                return initial_message(hps, bootstrap_images, seed, compressed)
+        return push_bootstrap(hps.bootstrap_codec, cs.empty_message((1,)), bootstrap_images, compressed)
+    print('Creating a virtual initial message...')
+    return virtual_message(int(hps.seed) if seed is None else seed, limit=int(hps.initial_bits))
+
+
+def rvae_serial_with_progress(codecs, previous_dims):
+    def push(message, symbols):
+        metrics = MessageMetrics(message, previous_dims)
+        t_start = time.time()
+
+        for i, (codec, symbol) in enumerate(reversed(list(zip(codecs, symbols)))):
+            t0 = time.time()
+            message = codec.push(message, symbol)
+            metrics.update(message, symbol.size)
+            print(f"Encoded {i+1}/{len(symbols)}[{(i+1)/float(len(symbols))*100:.0f}%], "
+                  f"message length: {metrics.words * (4/1024):.0f}kB, "
+                  f"bpd: {metrics.bpd:.2f}, "
+                  f"net bitrate: {metrics.net_bitrate:.2f}, "
+                  f"net dims: {metrics.net_dims}, "
+                  f"net bits: {metrics.net_bits}, "
+                  f"image bits: {metrics.symbol_bits[-1]}, "
+                  f"iter time: {time.time() - t0:.2f}s, "
+                  f"total time: {time.time() - t_start:.2f}s, "
+                  f"symbol shape: {symbol.shape}, "
+                  f"message length: {metrics.words * (4/1024):.0f}kB, "
+                  f"bpd: {metrics.bpd:.2f}"
+                  )
+        return message
+
+    def pop(message):
+        symbols = []
+        for _, symbol, message in iter_pop(codecs, message):
+            symbols.append(symbol)
+        return message, symbols
+
+    return cs.Codec(push, pop)
+
+
+def iter_pop(codecs, message):
+    """
+    Pops a symbol with each of codecs in turn, yielding the index of the symbol, the symbol and the
+    rest of the message as soon as it is popped, so that symbols need not be kept by the caller.
+    """
+    t_start = time.time()
+    for i, codec in enumerate(codecs):
+        t0 = time.time()
+        message, symbol = codec.pop(message)
+        print(f"Decoded {i+1}/{len(codecs)}[{(i+1)/float(len(codecs))*100:.0f}%], "
+              f"iter time: {time.time() - t0:.2f}s, "
+              f"total time: {time.time() - t_start:.2f}s")
+        yield i, symbol, message
+
+
+def rvae_variable_size_image_codec(codec_from_shape, latent_from_image_shape, dimensions=4,
+                                   dimension_bits=16):
+    """Codec for a single image of any size, whose shape is coded in the message."""
+    size_codec = cs.repeat(cs.Uniform(dimension_bits), dimensions)
+
+    def push(message, symbol):
+        """push sizes and array in alternating order"""
+        assert len(symbol.shape) == dimensions
+
+        codec = codec_from_shape(symbol.shape)
+        head_size = np.prod(latent_from_image_shape(symbol.shape)) + np.prod(symbol.shape)
+        message = cs.reshape_head(message, (head_size,))
+        message = codec.push(message, symbol)
+        message = cs.reshape_head(message, (1,))
+        message = size_codec.push(message, np.array(symbol.shape))
+        return message
+
+    def pop(message):
+        message, size = size_codec.pop(message)
+        # TODO make codec 0 dimensional:
+        size = np.array(size)[:, 0]
+        assert size.shape == (dimensions,)
+        size = size.astype(np.int)
+        head_size = np.prod(latent_from_image_shape(size)) + np.prod(size)
+        codec = codec_from_shape(tuple(size))
+
+        message = cs.reshape_head(message, (head_size,))
+        message, symbol = codec.pop(message)
+        message = cs.reshape_head(message, (1,))
+
+        return message, symbol
+
+    return cs.Codec(push, pop)
+
+
+def rvae_variable_size_codec(codec_from_shape, latent_from_image_shape, image_count,
+                             dimensions=4, dimension_bits=16, previous_dims=0):
+    codec = rvae_variable_size_image_codec(codec_from_shape, latent_from_image_shape, dimensions,
+                                           dimension_bits)
+    return rvae_serial_with_progress([codec] * image_count, previous_dims)
+
+
+def rvae_known_size_image_codec(codec_from_image_shape, latent_from_image_shape, shape):
+    """Codec for a single image of the given shape, reshaping the head as needed."""
+    head_shape = (np.prod(latent_from_image_shape(shape)) + np.prod(shape),)
+
+    def push(message, symbol):
+        message = cs.reshape_head(message, head_shape)
+        codec = codec_from_image_shape(shape)
+        message = codec.push(message, symbol)
+        return message
+
+    def pop(message):
+        message = cs.reshape_head(message, head_shape)
+        codec = codec_from_image_shape(shape)
+        message, symbol = codec.pop(message)
+        return message, symbol
+
+    return cs.Codec(push, pop)
+
+
+def rvae_variable_known_size_codec(codec_from_image_shape, latent_from_image_shape, shapes, previous_dims):
+    """
+    Applies given codecs in series on a sequence of symbols requiring various ANS stack head shapes.
+    The head shape required for each symbol is given through shapes.
+    """
+    return rvae_serial_with_progress([
+        rvae_known_size_image_codec(codec_from_image_shape, latent_from_image_shape, shape)
+        for shape in shapes], previous_dims)
+
+
+def chunk(images, chunk_size):
+    """Splits images into contiguous chunks of chunk_size images, to be coded as independent
+    chains. Each chunk pays for its own bootstrap, but can be decoded without the others."""
+    return [images[i:i + chunk_size] for i in range(0, len(images), chunk_size)]
+
+
+def unflatten_segments(segments, head_shape, virtual_tail=None, limit=None):
+    """
+    cs.unflatten of the concatenation of segments in reverse, as stored in archives (bottom of the
+    stack first). The segments become nodes of the tail as they are, so memory mapped segments are
+    not read until they are popped. If given, virtual_tail is the [seed, consumed words] of the
+    virtual initial message the chain started from, of which at most limit words can be taken.
+    Decoding only pops the words the encoder took, so it needs no limit.
+    """
+    *below, top = segments
+    head, tail = cs.unflatten(top, head_shape)
+    bottom = ()
+    for segment in below:
+        bottom = segment, bottom
+    message = head, _stack_tail(tail, bottom)
+    if virtual_tail is not None:
+        message = attach_virtual_tail(message, *virtual_tail, limit)
+    return message
+
+
+def _stack_tail(tail, bottom):
+    """The tail cons list with bottom in place of its terminating empty tuple."""
+    nodes = []
+    while tail:
+        node, tail = tail
+        nodes.append(node)
+    for node in reversed(nodes):
+        bottom = node, bottom
+    return bottom
+
+
+class TailSpiller:
+    """
+    Keeps the part of a message held in memory below buffer_words, by writing the bottom of its tail
+    to an archive as a segment and putting a memory map of that segment in its place. Spilled words
+    are only read back if they are popped again.
+    """
+
+    def __init__(self, writer, buffer_words):
+        self.writer = writer
+        self.buffer_words = buffer_words
+        self.spilled = []  # (memory map, [offset, length]) of each spilled segment, bottom first
+        self.spilled_words = 0
+        self.buffered_words = 0
+
+    def _segment(self, node):
+        """[offset, length] in the archive of a tail node that is a view of a spilled segment."""
+        address = node.__array_interface__['data'][0]
+        for mmap, (offset, length) in self.spilled:
+            start = mmap.__array_interface__['data'][0]
+            if start <= address < start + mmap.nbytes:
+                return [offset + (address - start) // mmap.itemsize, len(node)]
+        return None
+
+    def _buffered(self, tail):
+        nodes = []
+        while tail and self._segment(tail[0]) is None:
+            node, tail = tail
+            nodes.append(node)
+        return nodes, tail
+
+    def __call__(self, message):
+        head, tail = message
+        nodes, spilled_tail = self._buffered(tail)
+        self.buffered_words = sum(len(node) for node in nodes)
+        if self.buffered_words <= self.buffer_words:
+            return message
+
+        # keep the top half of the buffer, which is most likely to be popped next, but spill at least
+        # the bottom node, which may hold more than the whole buffer
+        kept_words, n_kept = 0, 0
+        while kept_words < self.buffer_words // 2 and n_kept < len(nodes) - 1:
+            kept_words += len(nodes[n_kept])
+            n_kept += 1
+        segment = self.writer.write_segment(np.concatenate(nodes[n_kept:]))
+        self.spilled.append((self.writer.map_segment(segment), segment))
+        self.spilled_words += segment[1]
+        self.buffered_words = kept_words
+        tail = self.spilled[-1][0], spilled_tail
+        for node in reversed(nodes[:n_kept]):
+            tail = node, tail
+        return head, tail
+
+    def finish(self, message):
+        """Writes the part of message in memory, returns the segments of the whole message."""
+        head, tail = message
+        nodes, spilled_tail = self._buffered(tail)
+        segments = []
+        while spilled_tail:
+            node, spilled_tail = spilled_tail
+            segments.insert(0, self._segment(node))
+        buffered = ()
+        for node in reversed(nodes):
+            buffered = node, buffered
+        return segments + [self.writer.write_segment(cs.flatten((head, buffered)))]
+
+
+def push_stream(codecs, spill, message, image_files, load_image, first_index=0, total=None,
+                duplicates=None):
+    """
+    Pushes image files onto message one at a time, returns the message and the shapes of the pushed
+    images. Images found in the DuplicateIndex duplicates, if given, are not pushed.
+    """
+    shapes = []
+    t_start = time.time()
+    for i, image_file in enumerate(image_files):
+        image = np.array([load_image(image_file)])
+        if duplicates is not None and duplicates.add(first_index + i, image[0]) is not None:
+            print(f"Skipped {first_index + i + 1}/{total or len(image_files)} {image_file}, "
+                  f"a duplicate of image {duplicates.references[first_index + i]}")
+            continue
+        message = spill(codecs.image_codec(image.shape).push(message, image))
+        shapes.append(image.shape)
+        print(f"Encoded {first_index + i + 1}/{total or len(image_files)} {image_file}, "
+              f"shape: {image.shape}, in memory: {spill.buffered_words * 4 / 2 ** 20:.1f}MB, "
+              f"spilled: {spill.spilled_words * 4 / 2 ** 20:.1f}MB, "
+              f"total time: {time.time() - t_start:.2f}s")
+    return message, shapes
+
+
+def stream_layout(shapes):
+    """Layout of images pushed one at a time: they are popped in reverse order of pushing."""
+    return dict(head_shape=[1], shapes=[[int(d) for d in shape] for shape in shapes[::-1]],
+                order=list(reversed(range(len(shapes)))))
+
+
+def pad_to_even(image):
+    """Pads a chw image to even sizes along both spatial axes, as the VAE halves them, by repeating
+    its last row and column."""
+    return np.pad(image, ((0, 0), (0, image.shape[1] % 2), (0, image.shape[2] % 2)), mode='edge')
+
+
+def even_loader(load_image, sizes):
+    """load_image, padding images with pad_to_even and appending their original spatial sizes to
+    sizes, to be stored in the archive header."""
+    def load(image_file):
+        image = load_image(image_file)
+        sizes.append([int(d) for d in image.shape[1:]])
+        return pad_to_even(image)
+    return load
+
+
+def crop_to_original(header, image_id, image):
+    """Crops a decoded chw image to the size it had before pad_to_even, if the header records it."""
+    if 'sizes' not in header:
+        return image
+    size = header['sizes'][image_id]
+    return image[:, :size[0], :size[1]]
+
+
+def output_file_name(header, image_id):
+    """Name of the PNG an image of an archive is written to: the name of the file it was compressed
+    from if the header records it, else its id."""
+    files = header.get('files')
+    return f"{Path(files[image_id]).stem}.png" if files else f"{image_id:05d}.png"
+
+
+def compress_stream(hps, checkpoint, image_files, path, load_image):
+    """
+    Compresses image files into a single chain of an archive at path, loading and coding one image
+    at a time. Once more than hps.stream_buffer_mb of the message is held in memory, its bottom is
+    spilled to the archive, so that memory use depends on the largest image and not on the number
+    of images. Images are decoded in the order of image_files. Images of odd height or width are
+    padded to even sizes, and their original sizes stored, see crop_to_original.
+    """
+    # the shapes of the images to come are not known
+    hps.compression_always_variable = True
+    np.seterr(divide='raise')
+    np.random.seed(int(hps.seed))
+    codecs = VAECodecs(hps, checkpoint)
+
+    n_bootstrap = min(hps.n_bootstrap, len(image_files))
+    sizes = []
+    load_image = even_loader(load_image, sizes)
+    duplicates = DuplicateIndex() if hps.dedup else None
+    with ArchiveWriter(path) as writer:
+        spill = TailSpiller(writer, hps.stream_buffer_mb * 2 ** 20 // 4)
+        bootstrap_images = [load_image(f) for f in image_files[:n_bootstrap]]
+        if duplicates is not None:
+            for i, image in enumerate(bootstrap_images):
+                duplicates.register(i, image)
+        message = initial_message(hps, [np.array([image]) for image in bootstrap_images])
+        t0 = time.time()
+        message, shapes = push_stream(codecs, spill, spill(message), image_files[n_bootstrap:],
+                                      load_image, n_bootstrap, len(image_files), duplicates)
+        push_time = time.time() - t0
+
+        message, consumed = detach_virtual_tail(cs.reshape_head(message, (1,)))
+        layout = dict(stream_layout(shapes), n_bootstrap=n_bootstrap)
+        if consumed is not None:
+            layout['virtual_tail'] = [int(hps.seed), consumed]
+        header = archive_header(hps, checkpoint, len(image_files))
+        header.update(files=[str(f) for f in image_files], sizes=sizes,
+                      chains=[dict(segments=spill.finish(message), layout=layout)])
+        if duplicates is not None:
+            header['duplicates'] = duplicates.header_references()
+            duplicates.report(push_time / max(sum(np.prod(shape) for shape in shapes), 1))
+        writer.finish(header)
+    codecs.close()
+    return header
+
+
+def append_to_archive(hps, checkpoint, path, image_files, load_image):
+    """
+    Pushes image files onto the chain of the archive at path, without decoding anything. The
+    stored segments are memory mapped and left as they are: only the new part of the message and a
+    new header are written, over the old header. The new images are decoded last.
+    """
+    header, _ = read_header(path)
+    adopt_archive_header(hps, checkpoint, header)
+    if len(header['chains']) != 1:
+        raise ValueError(f"Can only append to archives of a single chain, {path} has "
+                         f"{len(header['chains'])}")
+    np.seterr(divide='raise')
+    codecs = VAECodecs(hps, checkpoint)
+    chain = header['chains'][0]
+    appended = chain['layout'].setdefault('appended', [])
+    sizes = []
+    load_image = even_loader(load_image, sizes)
+    head_shape = tuple((appended[-1] if appended else chain['layout'])['head_shape'])
+
+    with ArchiveWriter(path, append=True) as writer:
+        spill = TailSpiller(writer, hps.stream_buffer_mb * 2 ** 20 // 4)
+        spill.spilled = [(writer.map_segment(segment), segment) for segment in chain['segments']]
+        virtual_tail = chain['layout'].get('virtual_tail')
+        # pushing pops bits back, possibly from the virtual tail, which is bounded as when encoding
+        message = unflatten_segments([mmap for mmap, _ in spill.spilled], head_shape, virtual_tail,
+                                     int(hps.initial_bits))
+        message, shapes = push_stream(codecs, spill, message, image_files, load_image,
+                                      header['image_count'], header['image_count'] + len(image_files))
+
+        message, consumed = detach_virtual_tail(cs.reshape_head(message, (1,)))
+        if consumed is not None:
+            virtual_tail[1] = consumed
+        appended.append(stream_layout(shapes))
+        chain['segments'] = spill.finish(message)
+        header['image_count'] += len(image_files)
+        if 'files' in header:
+            header['files'] += [str(f) for f in image_files]
+        if 'sizes' in header:
+            header['sizes'] += sizes
+        writer.finish(header)
+    codecs.close()
+    return header
+
+
+def partition(images, n_parts):
+    """Splits images into at most n_parts contiguous parts of roughly equal number of dims."""
+    n_parts = min(n_parts, len(images))
+    sizes = np.cumsum([image.size for image in images])
+    bounds = np.searchsorted(sizes, sizes[-1] * np.arange(1, n_parts) / n_parts) + 1
+    bounds = [0] + [int(b) for b in bounds] + [len(images)]
+    return [images[start:end] for start, end in zip(bounds[:-1], bounds[1:]) if end > start]
+
+
+def init_worker():
+    """Worker processes are spawned, so they need to parse the flags of the main process again."""
+    if not FLAGS.is_parsed():
+        FLAGS(sys.argv, known_only=True)
+
+
+def chain_executor(n_chains):
+    """Executor for coding n_chains chains. A single chain is coded on a thread of this process, to
+    save spawning a worker and parsing the flags again."""
+    if n_chains == 1:
+        return ThreadPoolExecutor(1)
+    return ProcessPoolExecutor(n_chains, mp_context=multiprocessing.get_context('spawn'),
+                               initializer=init_worker)
+
+
+_worker_codecs = {}
+
+
+def worker_codecs(hps, checkpoint):
+    """Codecs of a worker process, kept across calls so that each worker builds its graphs once."""
+    if checkpoint not in _worker_codecs:
+        _worker_codecs[checkpoint] = VAECodecs(hps, checkpoint)
+    return _worker_codecs[checkpoint]
+
+
+def encode_chain(hps, checkpoint, images, chain_index):
+    """
+    Encodes a list of images (chw arrays) into an independent bits-back chain, bootstrapped with
+    hps.bootstrap_codec on its first hps.n_bootstrap images. Returns the flattened message and the
+    layout needed to decode it.
+    """
+    np.seterr(divide='raise')
+    np.random.seed(int(hps.seed) + chain_index)
+    codecs = worker_codecs(hps, checkpoint)
+
+    bootstrap_images = [np.array([image]) for image in images[:hps.n_bootstrap]]
+    vae_indices = batch_indices([image.shape for image in images[hps.n_bootstrap:]],
+                                hps.compression_batch_size)
+    vae_images = [np.stack([images[hps.n_bootstrap + i] for i in indices]) for indices in vae_indices]
+    shapes = [batch.shape for batch in vae_images]
+    previous_dims = int(np.sum([batch.size for batch in bootstrap_images]))
+
+    t0 = time.time()
+    seed = int(hps.seed) + chain_index
+    with bootstrap_executor(hps.bootstrap_threads) as executor:
+        # the bootstrap images are compressed while the first VAE codec is built
+        compressed = compress_bootstrap(hps.bootstrap_codec, bootstrap_images, executor)
+        (vae_push, _), head_shape = codecs.serial_codec(shapes, previous_dims)
+        codecs.build_first(shapes)
+        message = initial_message(hps, bootstrap_images, seed, compressed)
+    bootstrap_words = len(cs.flatten(message))
+    message = vae_push(cs.reshape_head(message, head_shape), vae_images)
+    message, consumed = detach_virtual_tail(message)
+    encode_time = time.time() - t0
+
+    print(f"Chain {chain_index}: encoded {len(images)} images in {encode_time:.2f}s")
+    # worker codecs are kept across chains and never closed, and each chain starts from the priors
+    codecs.report_choices()
+    codecs.codec_from_shape.report()
+    layout = dict(chain_layout(head_shape, shapes, len(bootstrap_images), vae_indices),
+                  bootstrap_words=bootstrap_words)
+    if consumed is not None:
+        layout['virtual_tail'] = [seed, consumed]
+    return cs.flatten(message), layout
+
+
+def chain_layout(head_shape, shapes, n_bootstrap, vae_indices):
+    """What is needed besides the message to decode a chain, in a form that can be stored as JSON."""
+    return dict(head_shape=[int(d) for d in head_shape],
+                shapes=[[int(d) for d in shape] for shape in shapes],
+                n_bootstrap=int(n_bootstrap),
+                order=[int(i) for indices in vae_indices for i in indices])
+
+
+def iter_decode_chain(hps, checkpoint, segments, layout, on_preview=None):
+    """
+    Decodes a chain, yielding the id of each image (its position in the order the chain was encoded
+    in) and the image as soon as it is popped, newest first, whatever codec it was coded with. The
+    flattened message is given as segments stored bottom of the stack first, see archive.py. Images
+    appended to the chain (see append_to_archive) are the newest. Stopping early leaves the rest of
+    the chain unread. on_preview is called with the id and the preview_image of each VAE-coded
+    image once its latents are popped, before its pixels are.
+    """
+    np.seterr(divide='raise')
+    codecs = worker_codecs(hps, checkpoint)
+    parts = [layout] + layout.get('appended', [])
+    positions = chain_positions(layout)
+    popped = 0
+
+    def preview(batch):
+        for position, image in zip(positions[popped:], batch):
+            on_preview(position, image)
+
+    message = unflatten_segments(segments, tuple(parts[-1]['head_shape']), layout.get('virtual_tail'))
+    codecs.on_preview = None if on_preview is None else preview
+    try:
+        for part in reversed(parts):
+            shapes = [tuple(shape) for shape in part['shapes']]
+            if part is layout:
+                assert tuple(codecs.serial_codec(shapes)[1]) == tuple(layout['head_shape'])
+                batch_codecs = codecs.batch_codecs(shapes)
+            else:
+                batch_codecs = [codecs.image_codec(shape) for shape in shapes]
+            message = cs.reshape_head(message, tuple(part['head_shape']))
+            for _, batch, message in iter_pop(batch_codecs, message):
+                for image in batch:
+                    popped += 1
+                    yield positions[popped - 1], image
+    finally:
+        codecs.on_preview = None
+
+    message = cs.reshape_head(message, (1,))
+    with bootstrap_executor(hps.bootstrap_threads) as executor:
+        _, images = pop_bootstrap(hps.bootstrap_codec, message, layout['n_bootstrap'], executor)
+        for image in images:
+            popped += 1
+            yield positions[popped - 1], np.array(image.result())
+
+
+def decode_chain(hps, checkpoint, segments, layout, chain_index):
+    """Inverse of encode_chain, returns the images in their original order, see iter_decode_chain."""
+    t0 = time.time()
+    images = dict(iter_decode_chain(hps, checkpoint, segments, layout))
+    print(f"Chain {chain_index}: decoded {len(images)} images in {time.time() - t0:.2f}s")
+    return [images[i] for i in range(len(images))]
+
+
+def decode_newest(hps, checkpoint, path, count):
+    """
+    Pops only the count images pushed last onto the chain of the archive at path, using the shapes
+    in the header. Returns their image ids (positions in the order the archive decodes all images
+    in) and the images, newest first. The rest of the chain stays memory mapped and is not read, so
+    this takes time proportional to count and not to the size of the archive.
+    """
+    header, chains = read_archive(path)
+    adopt_archive_header(hps, checkpoint, header)
+    if len(chains) != 1:
+        raise ValueError(f"The newest images are only defined for archives of a single chain, {path} "
+                         f"has {len(chains)}")
+    newest = list(islice(iter_decode_chain(hps, checkpoint, chains[0], header['chains'][0]['layout']),
+                         count))
+    ids = coded_ids(header)
+    return [ids[position] for position, _ in newest], [image for _, image in newest]
+
+
+def decode_image(hps, checkpoint, path, image_id):
+    """Decodes a single image of an archive, found through the index of the archive, by popping only
+    the images pushed after it onto the chain holding it."""
+    header, _ = read_header(path)
+    adopt_archive_header(hps, checkpoint, header)
+    if not 0 <= image_id < header['image_count']:
+        raise ValueError(f"{path} holds {header['image_count']} images, there is no image {image_id}")
+    # the index counts coded images, duplicates are decoded from the image they refer to
+    position = coded_ids(header).index(references(header).get(image_id, image_id))
+    index = header.get('index', [0])
+    chain_index = int(np.searchsorted(index, position, side='right')) - 1
+    chain, segments = read_chain(path, chain_index)
+    for chain_position, image in iter_decode_chain(hps, checkpoint, segments, chain['layout']):
+        if chain_position == position - index[chain_index]:
+            return image
+    raise ValueError(f"Chain {chain_index} of {path} does not hold image {image_id}")
+
+
+def decode_progressively(hps, checkpoint, path):
+    """
+    Decodes the chains of an archive one after the other on a thread, and yields
+    ('preview', image_id, image) for each VAE-coded image as soon as its latents are popped, and
+    ('image', image_id, image) for every image once it is popped, whatever codec it was coded with,
+    followed by one for each of its duplicates. The preview is the mean of the likelihood, so it is
+    available long before the exact image. Images come in the order they are popped.
+    """
+    header, _ = read_header(path)
+    adopt_archive_header(hps, checkpoint, header)
+    ids = coded_ids(header)
+    events = queue.Queue()
+
+    def decode_chain_events(chain_index, first_id):
+        def on_preview(position, image):
+            image_id = ids[first_id + position]
+            events.put(('preview', image_id, crop_to_original(header, image_id, image)))
+
+        chain, segments = read_chain(path, chain_index)
+        decoded = ((first_id + position, image) for position, image in
+                   iter_decode_chain(hps, checkpoint, segments, chain['layout'], on_preview))
+        for image_id, image in iter_with_duplicates(header, decoded):
+            events.put(('image', image_id, crop_to_original(header, image_id, image)))
+
+    def decode():
+        try:
+            for chain_index, first_id in enumerate(header.get('index', [0])):
+                decode_chain_events(chain_index, first_id)
+            events.put(None)
+        except BaseException as e:
+            events.put(('error', e))
+
+    thread = threading.Thread(target=decode, daemon=True)
+    thread.start()
+    while True:
+        event = events.get()
+        if event is None:
+            break
+        if event[0] == 'error':
+            raise event[1]
+        yield event
+
+
+def decode_archived_chain(hps, checkpoint, path, chain_index):
+    """Decodes a chain of an archive file, memory mapped by the worker itself."""
+    chain, segments = read_chain(path, chain_index)
+    return decode_chain(hps, checkpoint, segments, chain['layout'], chain_index)
+
+
+def write_decoded_chain(hps, checkpoint, path, chain_index, output):
+    """
+    Decodes a chain of an archive file like decode_archived_chain, but writes each image and its
+    duplicates to the directory output as soon as it is popped, instead of returning the images.
+    Returns the number of images and dims written.
+    """
+    t0 = time.time()
+    header, _ = read_header(path)
+    chain, segments = read_chain(path, chain_index)
+    first_id = header.get('index', [0])[chain_index]
+    decoded = ((first_id + position, image)
+               for position, image in iter_decode_chain(hps, checkpoint, segments, chain['layout']))
+    n_images = n_dims = 0
+    for image_id, image in iter_with_duplicates(header, decoded):
+        image = crop_to_original(header, image_id, image)
+        array_to_image_file(image, Path(output) / output_file_name(header, image_id))
+        n_images += 1
+        n_dims += image.size
+    print(f"Chain {chain_index}: decoded and wrote {n_images} images in {time.time() - t0:.2f}s")
+    return n_images, n_dims
+
+
+def encode_chains(executor, hps, checkpoint, chains):
+    """Encodes each list of images in chains on the executor, returns the packed chains and their
+    layouts."""
+    n_chains = len(chains)
+    encoded = list(executor.map(encode_chain, [hps] * n_chains, [checkpoint] * n_chains,
+                                chains, range(n_chains)))
+    return pack_chains([flat_message for flat_message, _ in encoded]), \
+           [layout for _, layout in encoded]
+
+
+def decode_chains(executor, hps, checkpoint, words, layouts):
+    """Inverse of encode_chains, returns a list of images for each chain."""
+    n_chains = len(layouts)
+    return list(executor.map(decode_chain, [hps] * n_chains, [checkpoint] * n_chains,
+                             [[flat_message] for flat_message in unpack_chains(words)], layouts,
+                             range(n_chains)))
+
+
+def decode_archive(executor, hps, checkpoint, path):
+    """Decodes all chains of an archive file on the executor, returns a list of images per chain."""
+    header, _ = read_header(path)
+    adopt_archive_header(hps, checkpoint, header)
+    n_chains = len(header['chains'])
+    return list(executor.map(decode_archived_chain, [hps] * n_chains, [checkpoint] * n_chains,
+                             [path] * n_chains, range(n_chains)))
+
+
+def write_decoded_archive(executor, hps, checkpoint, path, output):
+    """Decodes all chains of an archive file on the executor, each worker writing the images of its
+    chain to the directory output, see write_decoded_chain. Returns the number of images and dims
+    written."""
+    header, _ = read_header(path)
+    adopt_archive_header(hps, checkpoint, header)
+    n_chains = len(header['chains'])
+    written = list(executor.map(write_decoded_chain, [hps] * n_chains, [checkpoint] * n_chains,
+                                [path] * n_chains, range(n_chains), [output] * n_chains))
+    return sum(n for n, _ in written), sum(dims for _, dims in written)
+
+
+def tile_image(image, tile_size):
+    """
+    Cuts a chw image into tiles of tile_size x tile_size pixels, row by row, the same way as
+    tiled_full in tf_train.images: the last row and column of tiles take the remaining pixels.
+    Returns the tiles and the number of tile rows and columns.
+    """
+    num_tiles_y, num_tiles_x = max(image.shape[1] // tile_size, 1), max(image.shape[2] // tile_size, 1)
+    rows = np.split(image, [i * tile_size for i in range(1, num_tiles_y)], axis=1)
+    tiles = [tile for row in rows
+             for tile in np.split(row, [i * tile_size for i in range(1, num_tiles_x)], axis=2)]
+    return tiles, (num_tiles_y, num_tiles_x)
+
+
+def decode_region(hps, checkpoint, path, x0, y0, x1, y1, executor=None):
+    """
+    Decodes the window [x0, x1) x [y0, y1) of an image compressed in strips (see
+    regions.strip_chains and tf_train.run_compress_regions), by decoding only the strips
+    intersecting it, on executor if given.
+    """
+    header, _ = read_header(path)
+    adopt_archive_header(hps, checkpoint, header)
+    decode = partial(decode_archived_chain, hps, checkpoint, path)
+    map_ = executor.map if executor is not None else map
+    return crop_region(header, lambda strips: map_(decode, strips), x0, y0, x1, y1)
+
+
+def untile_image(tiles, grid):
+    """Inverse of tile_image."""
+    num_tiles_y, num_tiles_x = grid
+    return np.concatenate([np.concatenate(tiles[y * num_tiles_x:(y + 1) * num_tiles_x], axis=2)
+                           for y in range(num_tiles_y)], axis=1)
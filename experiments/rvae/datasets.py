@@ -18,6 +18,21 @@ def image_files_to_array(image_files, max_pixels=default_max_pixels):
         for f in image_files])
 
 
+def image_file_list(path, suffixes=('.png', '.jpg', '.jpeg', '.ppm')):
+    """Image files in a directory, or listed one per line in a text file."""
+    path = Path(path)
+    if path.is_dir():
+        return sorted(p for p in path.iterdir() if p.suffix.lower() in suffixes)
+    return [Path(line.strip()) for line in path.read_text().splitlines() if line.strip()]
+
+
+def array_to_image_file(image, path):
+    """Inverse of image_files_to_array for a single chw image, without the scaling."""
+    import cv2
+
+    cv2.imwrite(str(path), np.swapaxes(image, 0, 2)[:, :, ::-1].astype(np.uint8))
+
+
 def sampling_testimage_paths(dir=Path('.'), size=2400):
     link = 'https://sourceforge.net/projects/testimages/files/' \
            'SAMPLING/8BIT/RGB/SAMPLING_8BIT_RGB_{}x{}.tar.bz2/download'.format(size, size)
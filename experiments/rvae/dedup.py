@@ -0,0 +1,91 @@
+import hashlib
+import time
+from collections import defaultdict
+
+import numpy as np
+
+
+def content_hash(image):
+    """Hash of the shape and pixels of an image."""
+    digest = hashlib.sha1(str(tuple(image.shape)).encode('utf-8'))
+    digest.update(np.ascontiguousarray(image).tobytes())
+    return digest.hexdigest()
+
+
+class DuplicateIndex:
+    """
+    Content-hash index of the images coded so far. Images identical to an earlier one are not coded,
+    but stored as a reference to the id of its first occurrence.
+    """
+
+    def __init__(self):
+        self.first_ids = {}
+        self.references = {}  # id of a duplicate -> id of the first occurrence of the image
+        self.count = 0
+        self.duplicate_dims = 0
+        self.hash_time = 0.
+
+    def register(self, image_id, image):
+        """Records an image that is coded whether or not it is a duplicate (e.g. a bootstrap image),
+        so that later images can refer to it."""
+        t0 = time.time()
+        key = content_hash(image)
+        self.hash_time += time.time() - t0
+        self.count += 1
+        self.first_ids.setdefault(key, image_id)
+
+    def add(self, image_id, image):
+        """Returns the id of an earlier identical image, or None if the image is to be coded."""
+        t0 = time.time()
+        key = content_hash(image)
+        self.hash_time += time.time() - t0
+        self.count += 1
+        source = self.first_ids.setdefault(key, image_id)
+        if source == image_id:
+            return None
+        self.references[image_id] = source
+        self.duplicate_dims += image.size
+        return source
+
+    def header_references(self):
+        return [[int(duplicate), int(source)] for duplicate, source in sorted(self.references.items())]
+
+    def report(self, seconds_per_dim):
+        """seconds_per_dim is the time coding takes per dim, to estimate the time saved."""
+        print(f"Dedup: {len(self.references)}/{self.count} images were duplicates "
+              f"(hit rate {len(self.references) / max(self.count, 1) * 100:.1f}%), "
+              f"hashing took {self.hash_time:.2f}s, "
+              f"estimated coding time saved: {self.duplicate_dims * seconds_per_dim:.2f}s")
+
+
+def references(header):
+    """The references of an archive header, as a dict from duplicate id to source id."""
+    return {duplicate: source for duplicate, source in header.get('duplicates', [])}
+
+
+def coded_ids(header):
+    """The image id of each coded image of an archive, in the order they were coded."""
+    duplicates = references(header)
+    return [i for i in range(header['image_count']) if i not in duplicates]
+
+
+def with_duplicates(header, coded_images):
+    """All images of an archive in order, from its coded images in the order they were coded."""
+    duplicates = references(header)
+    images = dict(zip(coded_ids(header), coded_images))
+    return [images[duplicates.get(i, i)] for i in range(header['image_count'])]
+
+
+def iter_with_duplicates(header, decoded):
+    """
+    Maps pairs (position among the coded images, image) from decoded to pairs (image id, image),
+    adding a pair for each duplicate of an image right after it.
+    """
+    ids = coded_ids(header)
+    duplicates_of = defaultdict(list)
+    for duplicate, source in references(header).items():
+        duplicates_of[source].append(duplicate)
+    for position, image in decoded:
+        yield ids[position], image
+        for duplicate in duplicates_of[ids[position]]:
+            yield duplicate, image
@@ -0,0 +1,43 @@
+import unittest
+
+import numpy as np
+
+from rvae.dedup import DuplicateIndex, coded_ids, iter_with_duplicates, with_duplicates
+
+
+def image(value):
+    return np.full((3, 2, 2), value, dtype='uint64')
+
+
+def stream_header(values, n_bootstrap):
+    """Header of images coded as compress_stream does, the first n_bootstrap of them regardless."""
+    duplicates = DuplicateIndex()
+    for i, value in enumerate(values[:n_bootstrap]):
+        duplicates.register(i, image(value))
+    for i, value in enumerate(values[n_bootstrap:], n_bootstrap):
+        duplicates.add(i, image(value))
+    return dict(image_count=len(values), duplicates=duplicates.header_references())
+
+
+class DedupTestCase(unittest.TestCase):
+    def test_duplicate_bootstrap_images_are_coded(self):
+        values = [0, 0, 2, 3, 4]
+        header = stream_header(values, n_bootstrap=2)
+        self.assertEqual(header['duplicates'], [])
+        self.assertEqual(coded_ids(header), [0, 1, 2, 3, 4])
+        coded = [image(values[i]) for i in coded_ids(header)]
+        self.assertEqual([int(im[0, 0, 0]) for im in with_duplicates(header, coded)], values)
+
+    def test_reference_to_bootstrap_image(self):
+        values = [0, 1, 0, 3, 1]
+        header = stream_header(values, n_bootstrap=2)
+        self.assertEqual(header['duplicates'], [[2, 0], [4, 1]])
+        self.assertEqual(coded_ids(header), [0, 1, 3])
+        coded = [image(values[i]) for i in coded_ids(header)]
+        self.assertEqual([int(im[0, 0, 0]) for im in with_duplicates(header, coded)], values)
+        decoded = dict(iter_with_duplicates(header, enumerate(coded)))
+        self.assertEqual([int(decoded[i][0, 0, 0]) for i in range(len(values))], values)
+
+
+if __name__ == '__main__':
+    unittest.main()
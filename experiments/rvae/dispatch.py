@@ -0,0 +1,203 @@
+"""
+Per-image choice between codecs on a single ANS stack. The index of the codec chosen for an image
+is pushed after the image, so that the decoder pops it first and knows which codec to pop with.
+"""
+
+import shutil
+import time
+from collections import Counter
+
+import craystack as cs
+import numpy as np
+
+from rvae.flif import FLIF
+from rvae.lossless import PNG, png_bytes
+from rvae.metrics import MessageSize
+
+VAE, FLAT, FLIF_TAG, PNG_TAG = 0, 1, 2, 3
+codec_names = {VAE: 'VAE', FLAT: 'flat', FLIF_TAG: 'FLIF', PNG_TAG: 'PNG'}
+tag_bits = 2
+
+
+def dispatch_codec(codecs, chooser, skip_vae=None):
+    """
+    Codec pushing each symbol with codecs[chooser.choose(symbol)], followed by the index of the
+    codec. The net bits and the time of each push are passed to chooser.record. skip_vae is called
+    with each symbol pushed with a codec other than the VAE, see ContextPrefetcher.skip.
+    """
+    tag_codec = cs.Uniform(tag_bits)
+
+    def push(message, symbol):
+        tag = chooser.choose(symbol)
+        if tag != VAE and skip_vae is not None:
+            skip_vae(symbol)
+        t0 = time.time()
+        start_words = chooser.message_size(message)
+        message = codecs[tag].push(message, symbol)
+        message = cs.reshape_head(message, (1,))
+        chooser.record(tag, symbol, 32 * (chooser.message_size(message) - start_words), time.time() - t0)
+        return tag_codec.push(message, np.array([tag]))
+
+    def pop(message):
+        message = cs.reshape_head(message, (1,))
+        message, tag = tag_codec.pop(message)
+        return codecs[int(np.array(tag)[0])].pop(message)
+
+    return cs.Codec(push, pop)
+
+
+def single_image_codec(codec, dtype='uint64'):
+    """Codec for batches of one image, of a codec for chw images such as FLIF, on a head of shape (1,)."""
+    repeated = cs.repeat(codec, 1)
+
+    def push(message, image):
+        return repeated.push(cs.reshape_head(message, (1,)), image)
+
+    def pop(message):
+        message, images = repeated.pop(message)
+        return message, np.array(images).astype(dtype)
+
+    return cs.Codec(push, pop)
+
+
+def range_bits(image):
+    """Number of bits needed for the pixels of an image batch, relative to the minimum of each channel."""
+    lows = image.min(axis=(0, 2, 3))
+    return int(np.max(image.max(axis=(0, 2, 3)) - lows)).bit_length()
+
+
+def flat_codec(max_bits, shape=None, dimensions=4, dimension_bits=16, dtype='uint64'):
+    """
+    Lightweight codec for image batches whose pixels lie within 2 ** bits of the minimum of their
+    channel, for bits <= max_bits: each pixel is coded as its offset from that minimum with bits
+    uniform bits, after which the minimums and bits are pushed. Constant images cost no more than
+    the minimums. If shape is None, the shape is coded as well.
+    """
+    size_codec = cs.repeat(cs.Uniform(dimension_bits), dimensions)
+    bits_codec = cs.Uniform(max(max_bits, 1).bit_length())
+
+    def push(message, image):
+        lows = image.min(axis=(0, 2, 3))
+        bits = range_bits(image)
+        assert bits <= max_bits, (bits, max_bits)
+        if bits:
+            message = cs.reshape_head(message, (image.size,))
+            message = cs.Uniform(bits).push(message, np.ravel(image - lows[None, :, None, None]))
+        message = cs.reshape_head(message, (1,))
+        message = cs.repeat(cs.Uniform(8), len(lows)).push(message, lows)
+        message = bits_codec.push(message, np.array([bits]))
+        if shape is None:
+            message = size_codec.push(message, np.array(image.shape))
+        return message
+
+    def pop(message):
+        image_shape = shape
+        if image_shape is None:
+            message, size = size_codec.pop(message)
+            image_shape = tuple(np.array(size)[:, 0].astype(int))
+        message, bits = bits_codec.pop(message)
+        bits = int(np.array(bits)[0])
+        message, lows = cs.repeat(cs.Uniform(8), image_shape[1]).pop(message)
+        lows = np.array(lows)[:, 0].astype(dtype)
+        image = np.zeros(image_shape, dtype)
+        if bits:
+            message = cs.reshape_head(message, (int(np.prod(image_shape)),))
+            message, offsets = cs.Uniform(bits).pop(message)
+            image = np.reshape(np.array(offsets), image_shape).astype(dtype)
+            message = cs.reshape_head(message, (1,))
+        return message, image + lows[None, :, None, None]
+
+    return cs.Codec(push, pop)
+
+
+def image_codecs(vae_codec, flat_max_bits, shape=None):
+    """All codecs a dispatch_codec may choose from, by tag. Decoding needs all of them."""
+    return {VAE: vae_codec,
+            FLAT: flat_codec(flat_max_bits, shape),
+            FLIF_TAG: single_image_codec(FLIF),
+            PNG_TAG: single_image_codec(PNG)}
+
+
+def dispatch_tags():
+    """Tags an encoder with codec_dispatch chooses from. FLIF is left out if the flif binary is not
+    installed."""
+    if shutil.which('flif') is None:
+        print("The flif binary was not found, images are not dispatched to FLIF")
+        return VAE, PNG_TAG
+    return VAE, FLIF_TAG, PNG_TAG
+
+
+class CodecChooser:
+    """
+    Chooses the codec of each image batch among tags by predicted cost, in bits plus
+    bits_per_second times seconds of encoding. If flat_max_bits is given, batches whose channels
+    span at most 2 ** flat_max_bits values go to the flat codec first. PNG is cheap enough for its
+    rate to be measured on each candidate image. The rates of the other codecs, and the times of
+    all of them, are running averages per dim over the batches they coded, starting from prior_bpd
+    and prior_seconds_per_dim. A codec without a prior time is assumed to be as slow as the slowest
+    codec with one, so that it is not taken to be free before it is tried. FLIF and PNG only take
+    batches of one 3-channel image.
+    """
+
+    def __init__(self, tags=(VAE,), flat_max_bits=None, bits_per_second=0., prior_bpd=None,
+                 prior_seconds_per_dim=None):
+        self.tags = tags
+        self.flat_max_bits = flat_max_bits
+        self.bits_per_second = bits_per_second
+        self.prior_bpd = prior_bpd or {}
+        self.prior_seconds_per_dim = prior_seconds_per_dim or {}
+        self.reset()
+
+    def reset(self):
+        """Forgets the batches coded so far, so that estimates start from the priors again."""
+        self.counts = Counter()
+        self.bits = Counter()
+        self.seconds = Counter()
+        self.dims = Counter()
+        # shared by the dispatch codecs of all images, as each measurement walks the tail nodes
+        # that are new since the last one
+        self.message_size = MessageSize()
+
+    def estimate(self, tag, image):
+        """Predicted bits and seconds of coding image with the codec of tag."""
+        dims = self.dims[tag]
+        if dims:
+            seconds_per_dim = self.seconds[tag] / dims
+        else:
+            seconds_per_dim = self.prior_seconds_per_dim.get(
+                tag, max(self.prior_seconds_per_dim.values(), default=0.))
+        seconds = seconds_per_dim * image.size
+        if tag == PNG_TAG:
+            return 8 * len(png_bytes(image[0])), seconds
+        bpd = self.bits[tag] / dims if dims else self.prior_bpd.get(tag, 8.)
+        return bpd * image.size, seconds
+
+    def candidates(self, image):
+        if image.shape[:2] == (1, 3):
+            return self.tags
+        return [tag for tag in self.tags if tag not in (FLIF_TAG, PNG_TAG)]
+
+    def choose(self, image):
+        if self.flat_max_bits is not None and range_bits(image) <= self.flat_max_bits:
+            return FLAT
+        candidates = self.candidates(image)
+        if len(candidates) == 1:
+            return candidates[0]
+        costs = {}
+        for tag in candidates:
+            bits, seconds = self.estimate(tag, image)
+            costs[tag] = bits + self.bits_per_second * seconds
+        return min(costs, key=costs.get)
+
+    def record(self, tag, image, bits, seconds):
+        self.counts[tag] += 1
+        self.bits[tag] += bits
+        self.seconds[tag] += seconds
+        self.dims[tag] += image.size
+
+    def report(self):
+        total = sum(self.counts.values())
+        for tag, count in sorted(self.counts.items()):
+            print(f"{codec_names[tag]}: {count} images ({count / max(total, 1) * 100:.1f}%), "
+                  f"net bpd: {self.bits[tag] / self.dims[tag]:.2f}, "
+                  f"time: {self.seconds[tag] / count:.3f}s per image")
@@ -0,0 +1,47 @@
+import unittest
+
+import craystack as cs
+import numpy as np
+
+from rvae.dispatch import flat_codec, range_bits
+
+
+class FlatCodecTestCase(unittest.TestCase):
+    max_bits = 4
+    lows = np.array([10, 0, 240], dtype='uint64')
+
+    def batch(self, bits):
+        """A batch of 2 images whose channels span exactly 2 ** bits values above self.lows."""
+        offsets = np.random.RandomState(0).randint(2 ** bits, size=(2, 3, 5, 7)).astype('uint64')
+        offsets[0, :, 0, 0] = 0
+        offsets[0, :, 0, 1] = 2 ** bits - 1
+        return offsets + self.lows[None, :, None, None]
+
+    def assert_round_trip(self, image):
+        for shape in (None, image.shape):
+            codec = flat_codec(self.max_bits, shape)
+            message = cs.random_message(8, (1,))
+            rest, decoded = codec.pop(codec.push(message, image))
+            self.assertEqual(decoded.shape, image.shape)
+            np.testing.assert_array_equal(decoded, image)
+            np.testing.assert_array_equal(cs.flatten(rest), cs.flatten(message))
+
+    def test_constant_batch(self):
+        image = self.batch(0)
+        self.assertEqual(range_bits(image), 0)
+        self.assert_round_trip(image)
+
+    def test_batch_spanning_max_bits(self):
+        image = self.batch(self.max_bits)
+        self.assertEqual(range_bits(image), self.max_bits)
+        self.assert_round_trip(image)
+
+    def test_constant_batch_is_cheap(self):
+        message = cs.random_message(8, (1,))
+        constant = flat_codec(self.max_bits).push(message, self.batch(0))
+        spanning = flat_codec(self.max_bits).push(message, self.batch(self.max_bits))
+        self.assertLess(len(cs.flatten(constant)), len(cs.flatten(spanning)))
+
+
+if __name__ == '__main__':
+    unittest.main()
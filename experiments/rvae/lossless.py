@@ -0,0 +1,45 @@
+import cv2
+import numpy as np
+
+from rvae.bytes_codec import Compressor, compressed_image_codec
+from rvae.flif import im_transform, inverse_im_transform
+
+
+png_params = [cv2.IMWRITE_PNG_COMPRESSION, 9]
+png_signature = b'\x89PNG\r\n\x1a\n'
+# OpenCV writes lossless WebP for qualities above 100
+webp_params = [cv2.IMWRITE_WEBP_QUALITY, 101]
+webp_signature = b'RIFF'
+
+
+def encoded_bytes(image, extension, params):
+    """File of a chw image in the format of extension, compressed in process by OpenCV."""
+    image = im_transform(image).astype(np.uint8)
+    success, im_buffer = cv2.imencode(extension, image, params)
+    if not success:
+        raise Exception(f"{extension} encode failed")
+    return im_buffer.tobytes()
+
+
+def png_bytes(image):
+    return encoded_bytes(image, ".png", png_params)
+
+
+def cv2_compressor(extension, params, signature):
+    """Compressor for chw images to a lossless format OpenCV can encode and decode."""
+    def compress(image):
+        """expects image to be chw"""
+        # take off the signature, which is the same for every file
+        return encoded_bytes(image, extension, params)[len(signature):]
+
+    def decompress(compressed_bytes):
+        im_buffer = np.frombuffer(signature + compressed_bytes, dtype=np.uint8)
+        image = cv2.imdecode(im_buffer, flags=1)  # this gives in hwc
+        return inverse_im_transform(image)
+    return Compressor(compress, decompress)
+
+
+PNG_COMPRESSOR = cv2_compressor(".png", png_params, png_signature)
+WEBP_COMPRESSOR = cv2_compressor(".webp", webp_params, webp_signature)
+PNG = compressed_image_codec(PNG_COMPRESSOR)
+WEBP = compressed_image_codec(WEBP_COMPRESSOR)
@@ -0,0 +1,86 @@
+import numpy as np
+
+
+class MessageSize:
+    """
+    Number of words of cs.flatten(message), for a sequence of messages of the same chain.
+
+    The tail nodes of the last message measured are kept bottom first, with the number of words
+    from the bottom up to each of them. Pushing puts new nodes on the tail and popping removes them
+    (or puts a slice of a node on what is below it), so measuring a message only walks the nodes
+    that are new since the last one, and drops those that are gone. Measuring after every image
+    then costs time proportional to the nodes pushed and popped, not to the size of the message.
+    """
+
+    def __init__(self):
+        self._nodes = []  # the tail tuples (node, rest) of the last message, bottom first
+        self._words = []  # words of each tuple and all those below it
+        self._positions = {}  # id of each tuple in _nodes -> its position
+        self.walked = 0  # tuples walked so far, in total
+
+    def __call__(self, message):
+        head, tail = message
+        new = []
+        # the bottom of a tail (an empty tuple, or a virtual tail) is falsy
+        while tail and not self._known(tail):
+            new.append(tail)
+            tail = tail[1]
+        self.walked += len(new)
+
+        depth = self._positions[id(tail)] + 1 if tail else 0
+        for node in self._nodes[depth:]:
+            del self._positions[id(node)]
+        del self._nodes[depth:]
+        del self._words[depth:]
+
+        words = self._words[-1] if self._words else 0
+        for node in reversed(new):
+            words += len(node[0])
+            self._positions[id(node)] = len(self._nodes)
+            self._nodes.append(node)
+            self._words.append(words)
+        return 2 * np.size(head) + words
+
+    def _known(self, tail):
+        position = self._positions.get(id(tail))
+        return position is not None and self._nodes[position] is tail
+
+
+class MessageMetrics:
+    """
+    Running size of a message that symbols are pushed onto, and the bits each push added, from
+    MessageSize. previous_dims is the number of dims already coded in the initial message.
+    """
+
+    def __init__(self, message, previous_dims=0):
+        self.size = MessageSize()
+        self.initial_words = self.words = self.size(message)
+        self.previous_dims = self.dims = previous_dims
+        self.symbol_bits = []  # net bits of each push
+
+    def update(self, message, dims):
+        """Records a push of dims dims that resulted in message."""
+        words = self.size(message)
+        self.symbol_bits.append(32 * (words - self.words))
+        self.words = words
+        self.dims += dims
+
+    @property
+    def bits(self):
+        return 32 * self.words
+
+    @property
+    def net_bits(self):
+        return 32 * (self.words - self.initial_words)
+
+    @property
+    def net_dims(self):
+        return self.dims - self.previous_dims
+
+    @property
+    def bpd(self):
+        return self.bits / float(self.dims)
+
+    @property
+    def net_bitrate(self):
+        return self.net_bits / float(self.net_dims)
@@ -0,0 +1,98 @@
+import time
+import unittest
+
+import numpy as np
+
+from rvae.metrics import MessageMetrics, MessageSize
+
+
+def push(message, words):
+    head, tail = message
+    return head, (words, tail)
+
+
+def pop(message, n):
+    """Pops n words off the tail as craystack does, slicing the last node popped from."""
+    head, tail = message
+    while n > 0:
+        node, tail = tail
+        if n < len(node):
+            tail = node[n:], tail
+        n -= len(node)
+    return head, tail
+
+
+def flattened_words(message):
+    head, tail = message
+    words = 2 * np.size(head)
+    while tail:
+        node, tail = tail
+        words += len(node)
+    return words
+
+
+def encode(n_images, rng, size=None):
+    """Pushes and pops like a bits-back encode of n_images images, measuring after each image."""
+    size = size or MessageSize()
+    message = np.zeros(4, np.uint64), (rng.randint(1 << 32, size=100, dtype=np.uint32), ())
+    tail_words = 100
+    for _ in range(n_images):
+        message = pop(message, min(rng.randint(1, 50), tail_words))
+        for _ in range(rng.randint(1, 4)):
+            message = push(message, rng.randint(1 << 32, size=rng.randint(1, 30), dtype=np.uint32))
+        words = size(message)
+        tail_words = words - 8
+        yield words, message
+
+
+class MessageSizeTestCase(unittest.TestCase):
+    def test_matches_flatten(self):
+        for words, message in encode(1000, np.random.RandomState(0)):
+            self.assertEqual(words, flattened_words(message))
+
+    def test_new_chain(self):
+        size = MessageSize()
+        rng = np.random.RandomState(1)
+        for _ in encode(10, rng, size):
+            pass
+        for words, message in encode(10, rng, size):
+            self.assertEqual(words, flattened_words(message))
+
+    def test_walks_linear_in_image_count(self):
+        size = MessageSize()
+        for _ in encode(1000, np.random.RandomState(2), size):
+            pass
+        # each image pushes at most 3 nodes and slices one
+        self.assertLessEqual(size.walked, 1 + 4 * 1000)
+
+    def test_time_linear_in_image_count(self):
+        def encode_time(n_images):
+            times = []
+            for _ in range(3):
+                t0 = time.time()
+                for _ in encode(n_images, np.random.RandomState(3)):
+                    pass
+                times.append(time.time() - t0)
+            return min(times)
+
+        # quadratic time would take 16 times as long for 4 times the images
+        self.assertLess(encode_time(8000), 8 * encode_time(2000))
+
+
+class MessageMetricsTestCase(unittest.TestCase):
+    def test_bits(self):
+        message = np.zeros(2, np.uint64), ()
+        metrics = MessageMetrics(message, previous_dims=10)
+        message = push(message, np.zeros(3, np.uint32))
+        metrics.update(message, 6)
+        message = pop(message, 1)
+        metrics.update(message, 2)
+        self.assertEqual(metrics.symbol_bits, [96, -32])
+        self.assertEqual(metrics.bits, 32 * 6)
+        self.assertEqual(metrics.net_bits, 64)
+        self.assertEqual(metrics.net_dims, 8)
+        self.assertEqual(metrics.bpd, 32 * 6 / 18.)
+
+
+if __name__ == '__main__':
+    unittest.main()
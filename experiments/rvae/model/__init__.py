@@ -21,6 +21,20 @@ flags.DEFINE_string("evalmodel", "20190130-182348_depth=1,num_blocks=4,kl_min=0.
                     "otherwise TF1.10+ model from specified relative path. "
                     "If the specified path is a directory, will load the latest checkpoint.")
 flags.DEFINE_integer("num_gpus", 1, "Number of GPUs used.")
+flags.DEFINE_string("archive", None, "Path of the archive file written and decoded in 'bbans' mode, "
+                                      "written in 'compress' mode and read in 'decompress' and 'verify' mode.")
+flags.DEFINE_string("input", None, "Directory of images, or text file listing image paths, to "
+                                    "compress in 'compress_stream' and 'append' mode.")
+flags.DEFINE_integer("newest", 0, "If positive, only decode this many images added last to the "
+                                  "archive in 'decompress' mode.")
+flags.DEFINE_string("image_ids", None, "Comma separated ids of single images to decode in 'decompress' "
+                                        "mode.")
+flags.DEFINE_string("region", None, "Window x0,y0,x1,y1 of an image compressed in 'compress_regions' mode "
+                                     "to decode in 'decompress' mode.")
+flags.DEFINE_string("output", None, "Directory decoded images are written to in 'decompress' and 'preview' "
+                                     "mode.")
+flags.DEFINE_string("chunk_sizes", "4,16,64", "Comma separated chunk sizes compared in 'benchmark_chunks' "
+                                               "mode.")
 FLAGS = flags.FLAGS
 
 
@@ -120,6 +134,8 @@ class CVAE1(object):
     def __init__(self, hps, mode, x):
         self.hps = hps.copy()
         self.image_size = hps.image_size
+        # Height and width may be None, the graph then serves every image size:
+        self.is_polymorphic = None in tuple(hps.image_size)
         self.mode = mode
         self.x = x
         self.m_trunc = []
@@ -136,7 +152,10 @@ class CVAE1(object):
         xs = tf.split(self.x, hps.num_gpus)
         opt = AdamaxOptimizer(hps.learning_rate)
 
-        num_pixels = 3 * np.prod(hps.image_size)
+        if self.is_polymorphic:
+            num_pixels = tf.to_float(3 * tf.reduce_prod(tf.shape(self.x)[2:]))
+        else:
+            num_pixels = 3 * np.prod(hps.image_size)
         for i in range(hps.num_gpus):
             with tf.device(assign_to_gpu(i)):
                 m, obj, loss = self._forward(xs[i], i)
@@ -186,7 +205,7 @@ class CVAE1(object):
             for layer in self.layers:
                 input = layer.up(input)
 
-            input = self.initial_input_down()
+            input = self.initial_input_down(like=input if self.is_polymorphic else None)
             kl_cost = kl_obj = 0.0
 
             for j, layer in reversed(list(enumerate(self.layers))):
@@ -217,11 +236,16 @@ class CVAE1(object):
         return [IAFLayer(self.hps, self.mode, scope=tf.variable_scope("IAF_0_%d" % j))
                 for j in range(self.hps.num_blocks)]
 
-    def initial_input_down(self):
+    def initial_input_down(self, like=None):
+        """Tiles h_top to the hidden shape. If given, the spatial size is taken at run time from
+        the hidden tensor like, which is needed if the graph is built with unknown image size."""
         self.h_top = tf.get_variable("h_top", [self.hps.h_size], initializer=tf.zeros_initializer)
-        return tf.tile(tf.reshape(self.h_top, [1, -1, 1, 1]),
-                       [self.data_size, 1, self.image_size[0] // 2,
-                        self.image_size[1] // 2])
+        if like is None:
+            multiples = [self.data_size, 1, self.image_size[0] // 2, self.image_size[1] // 2]
+        else:
+            like_shape = tf.shape(like)
+            multiples = tf.stack([self.data_size, 1, like_shape[2], like_shape[3]])
+        return tf.tile(tf.reshape(self.h_top, [1, -1, 1, 1]), multiples)
 
     def upsample_and_postprocess(self, input):
         x = tf.nn.elu(input)
@@ -22,12 +22,15 @@ class LayerwiseCVAE:
 
             self.top_context_inputs = create_context_inputs(self.model.hps, prefix='top_')
 
-            input = self.model.initial_input_down()
+            input = self.model.initial_input_down(
+                like=self.top_context_inputs[2] if self.model.is_polymorphic else None)
             h_det, posterior, prior, _ = self.iaf_layers[-1].down_split(input,
                                                                         *self.top_context_inputs)
             top_inputs = (h_det, input)
             self.top_posterior_params_and_inputs = (posterior.mean, posterior.std), top_inputs
             self.top_prior_params_and_inputs = (prior.mean, prior.std), top_inputs
+            self.top_prior_and_posterior_params_and_inputs = \
+                (prior.mean, prior.std), (posterior.mean, posterior.std), top_inputs
 
             self.bottom_down_inputs = create_down_inputs(self.model.hps, prefix='bottom_')
             input = self.iaf_layers[0].down_merge(*self.bottom_down_inputs)
@@ -37,25 +40,73 @@ class LayerwiseCVAE:
         return sess.run(self.outputs,
                         dict(zip(self.bottom_down_inputs, bottom_outputs + (sample,))))
 
-    def run_top_prior(self, sess):
+    def run_top_prior(self, sess, shape=None):
         return sess.run(self.top_prior_params_and_inputs,
-                        dict(zip(self.top_context_inputs, prior_contexts(self.model.hps))))
+                        dict(zip(self.top_context_inputs, prior_contexts(self.model.hps, shape))))
 
     def run_top_posterior(self, sess, contexts):
         return sess.run(self.top_posterior_params_and_inputs,
                         dict(zip(self.top_context_inputs, contexts)))
 
-    def run_all_contexts(self, sess, x):
-        return sess.run([(layer.qz_mean, layer.qz_logsd, layer.up_context)
-                         for layer in self.iaf_layers], feed_dict={self.model.x: x})
+    def run_top_prior_and_posterior(self, sess, contexts):
+        return sess.run(self.top_prior_and_posterior_params_and_inputs,
+                        dict(zip(self.top_context_inputs, contexts)))
 
-    def get_model_parts_as_numpy_functions(self, sess):
-        return partial(self.run_all_contexts, sess), \
-               partial(self.run_top_prior, sess), \
-               tuple(partial(layer.run_down_prior, sess) for layer in self.latent_layers), \
-               partial(self.run_top_posterior, sess), \
-               tuple(partial(layer.run_down_posterior, sess) for layer in self.latent_layers), \
-               partial(self.run_reconstruction, sess)
+    def run_all_contexts(self, sess, x):
+        return sess.run(self.all_contexts, feed_dict={self.model.x: x})
+
+    @property
+    def all_contexts(self):
+        return [(layer.qz_mean, layer.qz_logsd, layer.up_context) for layer in self.iaf_layers]
+
+    def get_model_parts_as_numpy_functions(self, sess, shape=None, precompiled=True):
+        """
+        shape is the image shape to code, required if the model was built with unknown image size.
+        If precompiled, the functions are created with Session.make_callable, so that feed and fetch
+        handling is done once instead of on every call.
+        """
+        assert shape is not None or not self.model.is_polymorphic
+        if not precompiled:
+            return partial(self.run_all_contexts, sess), \
+                   partial(self.run_top_prior, sess, shape), \
+                   tuple(partial(layer.run_down_prior, sess) for layer in self.latent_layers), \
+                   partial(self.run_top_posterior, sess), \
+                   tuple(partial(layer.run_down_posterior, sess) for layer in self.latent_layers), \
+                   partial(self.run_reconstruction, sess)
+
+        # without downsampling, all latent layers share the prior contexts of the top layer:
+        contexts = as_float32(*prior_contexts(self.model.hps, shape))
+
+        all_contexts = sess.make_callable(self.all_contexts, [self.model.x])
+        top_prior = sess.make_callable(self.top_prior_params_and_inputs,
+                                       list(self.top_context_inputs))
+        top_posterior = sess.make_callable(self.top_posterior_params_and_inputs,
+                                           list(self.top_context_inputs))
+        reconstruction = sess.make_callable(self.outputs, list(self.bottom_down_inputs))
+
+        return lambda x: all_contexts(*as_float32(x)), \
+               lambda: top_prior(*contexts), \
+               tuple(layer.make_down_prior(sess, contexts) for layer in self.latent_layers), \
+               lambda up_contexts: top_posterior(*as_float32(*up_contexts)), \
+               tuple(layer.make_down_posterior(sess) for layer in self.latent_layers), \
+               lambda bottom_outputs, sample: reconstruction(*as_float32(*bottom_outputs, sample))
+
+
+    def get_fused_parts_as_numpy_functions(self, sess, precompiled=True):
+        """
+        Functions returning prior params, posterior params and the next hidden state of a layer in a
+        single execution, for the top and for each latent layer. The hidden state of the down pass
+        does not depend on the contexts, so it is shared by the prior and the posterior.
+        """
+        if not precompiled:
+            return partial(self.run_top_prior_and_posterior, sess), \
+                   tuple(partial(layer.run_down_prior_and_posterior, sess)
+                         for layer in self.latent_layers)
+
+        top = sess.make_callable(self.top_prior_and_posterior_params_and_inputs,
+                                 list(self.top_context_inputs))
+        return lambda up_contexts: top(*as_float32(*up_contexts)), \
+               tuple(layer.make_down_prior_and_posterior(sess) for layer in self.latent_layers)
 
 
 class LatentLayer:
@@ -77,20 +128,44 @@ class LatentLayer:
             self.down_outputs = self.h_det_out, self.down_output
             self.prior_params = prior.mean, prior.std
             self.posterior_params = posterior.mean, posterior.std
+            self.prior_and_posterior_params = self.prior_params, self.posterior_params
 
     def run_down_prior(self, sess: tf.Session, outputs, sample):
         return sess.run((self.prior_params, self.down_outputs),
                         {**dict(zip(self.down_inputs, outputs + (sample,))),
-                         **dict(zip(self.context_inputs, prior_contexts(self.hps)))})
+                         **dict(zip(self.context_inputs, prior_contexts_like(sample, outputs[0])))})
 
     def run_down_posterior(self, sess: tf.Session, outputs, sample, up_contexts):
         return sess.run((self.posterior_params, self.down_outputs),
                         {**dict(zip(self.down_inputs, outputs + (sample,))),
                          **dict(zip(self.context_inputs, up_contexts))})
 
+    def run_down_prior_and_posterior(self, sess: tf.Session, outputs, sample, up_contexts):
+        return sess.run((*self.prior_and_posterior_params, self.down_outputs),
+                        {**dict(zip(self.down_inputs, outputs + (sample,))),
+                         **dict(zip(self.context_inputs, up_contexts))})
+
+    def make_down_prior(self, sess: tf.Session, contexts):
+        """Precompiled run_down_prior, contexts are the (float32) prior contexts of this layer."""
+        run = sess.make_callable((self.prior_params, self.down_outputs),
+                                 list(self.down_inputs + self.context_inputs))
+        return lambda outputs, sample: run(*as_float32(*outputs, sample), *contexts)
+
+    def make_down_posterior(self, sess: tf.Session):
+        """Precompiled run_down_posterior."""
+        run = sess.make_callable((self.posterior_params, self.down_outputs),
+                                 list(self.down_inputs + self.context_inputs))
+        return lambda outputs, sample, up_contexts: run(*as_float32(*outputs, sample, *up_contexts))
+
+    def make_down_prior_and_posterior(self, sess: tf.Session):
+        """Precompiled run_down_prior_and_posterior."""
+        run = sess.make_callable((*self.prior_and_posterior_params, self.down_outputs),
+                                 list(self.down_inputs + self.context_inputs))
+        return lambda outputs, sample, up_contexts: run(*as_float32(*outputs, sample, *up_contexts))
+
 
 def hidden_shape(hps):
-    return hps.batch_size * hps.k, hps.h_size, hps.image_size[0] // 2, hps.image_size[1] // 2
+    return hidden_from_image_shape(hps)(image_shape(hps))
 
 
 def latent_shape(hps):
@@ -102,7 +177,16 @@ def image_shape(hps):
 
 
 def latent_from_image_shape(hps):
-    return lambda s: (s[0], hps.z_size, s[2] // 2, s[3] // 2)
+    return lambda s: (s[0], hps.z_size, half(s[2]), half(s[3]))
+
+
+def hidden_from_image_shape(hps):
+    return lambda s: (s[0], hps.h_size, half(s[2]), half(s[3]))
+
+
+def half(size):
+    """Halves a spatial size, which is None for graphs built with unknown image size."""
+    return None if size is None else size // 2
 
 
 def create_down_inputs(hps, prefix=''):
@@ -119,5 +203,17 @@ def create_context_inputs(hps, prefix=''):
     return qz_mean_input, qz_logstd_input, up_context_input
 
 
-def prior_contexts(hps):
-    return np.zeros(latent_shape(hps)), np.zeros(latent_shape(hps)), np.zeros(hidden_shape(hps))
+def prior_contexts(hps, shape=None):
+    """Contexts for the prior, for the given image shape (by default the one in hps)."""
+    shape = image_shape(hps) if shape is None else shape
+    z_shape = latent_from_image_shape(hps)(shape)
+    return np.zeros(z_shape), np.zeros(z_shape), np.zeros(hidden_from_image_shape(hps)(shape))
+
+
+def prior_contexts_like(sample, hidden):
+    return np.zeros(np.shape(sample)), np.zeros(np.shape(sample)), np.zeros(np.shape(hidden))
+
+
+def as_float32(*arrays):
+    """Callables created by Session.make_callable do not convert their inputs to the placeholder type."""
+    return tuple(np.asarray(a, np.float32) for a in arrays)
@@ -0,0 +1,90 @@
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+class ContextPrefetcher:
+    """
+    Computes the deterministic up-pass contexts of the next depth images on a worker thread, while
+    the current image is being coded. images must be given in the order in which they are pushed.
+
+    try_up_pass(image) runs on the worker thread and may return None if the contexts can not be
+    computed there (e.g. because the codec for the image's shape is not built yet), in which case
+    they are computed in line when the image is pushed. Images that are not pushed with the VAE
+    (e.g. those a dispatch codec codes with another codec) must be passed to skip instead, so that
+    the images after them can still be matched.
+    """
+
+    def __init__(self, try_up_pass, images, depth):
+        assert depth >= 1
+        self.try_up_pass = try_up_pass
+        self.depth = depth
+        self._images = iter(images)
+        self._pending = deque()
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+        self.prefetched = 0
+        self.in_line = 0
+        self.skipped = 0
+        self.prefetch_time = 0.
+        self.in_line_time = 0.
+        self.wait_time = 0.
+
+        for _ in range(depth):
+            self._submit_next()
+
+    def _submit_next(self):
+        image = next(self._images, None)
+        if image is not None:
+            self._pending.append((image, self._executor.submit(self._timed_up_pass, image)))
+
+    def _timed_up_pass(self, image):
+        t0 = time.time()
+        contexts = self.try_up_pass(image)
+        if contexts is not None:
+            self.prefetch_time += time.time() - t0
+        return contexts
+
+    def up_pass(self, up_pass, image):
+        """Replacement for up_pass(image), using the prefetched contexts if image is next in line."""
+        contexts = None
+        if self._pending and is_same_image(self._pending[0][0], image):
+            _, future = self._pending.popleft()
+            self._submit_next()
+            t0 = time.time()
+            contexts = future.result()
+            self.wait_time += time.time() - t0
+
+        if contexts is None:
+            self.in_line += 1
+            t0 = time.time()
+            contexts = up_pass(image)
+            self.in_line_time += time.time() - t0
+        else:
+            self.prefetched += 1
+        return contexts
+
+    def skip(self, image):
+        """Discards the contexts of image if it is next in line, as it is pushed without an up pass."""
+        if self._pending and is_same_image(self._pending[0][0], image):
+            _, future = self._pending.popleft()
+            future.cancel()
+            self._submit_next()
+            self.skipped += 1
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+    def report(self):
+        up_pass_time = self.prefetch_time + self.in_line_time
+        hidden_time = max(self.prefetch_time - self.wait_time, 0.)
+        print(f"Context prefetch: depth {self.depth}, prefetched: {self.prefetched}, "
+              f"in line: {self.in_line}, skipped: {self.skipped}, up pass time: {up_pass_time:.2f}s, "
+              f"waited: {self.wait_time:.2f}s, "
+              f"overlap: {hidden_time / max(up_pass_time, 1e-12) * 100:.0f}%")
+
+
+def is_same_image(a, b):
+    return a is b or (a.shape == b.shape and np.array_equal(a, b))
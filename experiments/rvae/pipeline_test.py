@@ -0,0 +1,28 @@
+import unittest
+
+import numpy as np
+
+from rvae.pipeline import ContextPrefetcher
+
+
+class ContextPrefetcherTestCase(unittest.TestCase):
+    def test_skipped_images_do_not_stall_prefetching(self):
+        images = [np.full((1, 3, 2, 2), i) for i in range(4)]
+        prefetcher = ContextPrefetcher(lambda image: int(image[0, 0, 0, 0]), images, depth=1)
+
+        def in_line(image):
+            raise AssertionError("contexts were not prefetched")
+
+        try:
+            self.assertEqual(prefetcher.up_pass(in_line, images[0]), 0)
+            # e.g. coded flat by a dispatch codec
+            prefetcher.skip(images[1])
+            self.assertEqual(prefetcher.up_pass(in_line, images[2]), 2)
+            self.assertEqual(prefetcher.up_pass(in_line, images[3]), 3)
+        finally:
+            prefetcher.close()
+        self.assertEqual((prefetcher.prefetched, prefetcher.skipped, prefetcher.in_line), (3, 1, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
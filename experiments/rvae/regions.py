@@ -0,0 +1,41 @@
+"""
+Region-of-interest decoding of large images coded in strips.
+
+Images are arrays indexed [channel, x, y] (see datasets.image_files_to_array). An image is cut into
+horizontal strips of rows, each coded as an independent chain of tiles, and the archive header
+holds the image shape and the [top, bottom] rows of each strip, so that a window can be decoded by
+decoding only the strips intersecting it.
+"""
+import numpy as np
+
+
+def strip_chains(image, tile_size):
+    """
+    Cuts an image into horizontal strips of tile_size rows, and each strip into tiles of tile_size
+    columns, to be coded as a chain per strip. As in compression.tile_image, the last strip and the
+    last tile of each strip take the remaining pixels. Returns the chains and the [top, bottom]
+    rows of each strip.
+    """
+    _, width, height = image.shape
+    strips = np.split(image, [i * tile_size for i in range(1, max(height // tile_size, 1))], axis=2)
+    chains = [np.split(strip, [i * tile_size for i in range(1, max(width // tile_size, 1))], axis=1)
+              for strip in strips]
+    bottoms = np.cumsum([strip.shape[2] for strip in strips])
+    return chains, [[int(bottom - strip.shape[2]), int(bottom)]
+                    for strip, bottom in zip(strips, bottoms)]
+
+
+def crop_region(header, decode_strips, x0, y0, x1, y1):
+    """
+    Returns the window [x0, x1) x [y0, y1) of the image described by header, given
+    decode_strips(indices), which returns the list of tiles of each strip in indices. Only the
+    strips intersecting the window are decoded.
+    """
+    _, width, height = header['image_shape']
+    if not (0 <= x0 < x1 <= width and 0 <= y0 < y1 <= height):
+        raise ValueError(f"Region ({x0}, {y0}, {x1}, {y1}) is not within the {width}x{height} image")
+    strips = [i for i, (top, bottom) in enumerate(header['strips']) if top < y1 and bottom > y0]
+    decoded = list(decode_strips(strips))
+    region = np.concatenate([np.concatenate(tiles, axis=1) for tiles in decoded], axis=2)
+    top = header['strips'][strips[0]][0]
+    return region[:, x0:x1, y0 - top:y1 - top]
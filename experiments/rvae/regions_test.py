@@ -0,0 +1,46 @@
+import unittest
+
+import numpy as np
+
+from rvae.regions import crop_region, strip_chains
+
+
+class RegionsTestCase(unittest.TestCase):
+    def setUp(self):
+        # 3 channels, 70 columns (x), 45 rows (y)
+        self.image = np.random.RandomState(0).randint(256, size=(3, 70, 45), dtype=np.uint8)
+        self.chains, self.strips = strip_chains(self.image, 16)
+        self.header = dict(image_shape=list(self.image.shape), strips=self.strips)
+        self.decoded = []
+
+    def decode_strips(self, strips):
+        """Stands in for decoding the chain of each strip."""
+        self.decoded.extend(strips)
+        return [self.chains[i] for i in strips]
+
+    def test_strips(self):
+        self.assertEqual(self.strips, [[0, 16], [16, 45]])
+        for chain, (top, bottom) in zip(self.chains, self.strips):
+            self.assertEqual([tile.shape for tile in chain],
+                             [(3, 16, bottom - top)] * 3 + [(3, 22, bottom - top)])
+            np.testing.assert_array_equal(np.concatenate(chain, axis=1), self.image[:, :, top:bottom])
+
+    def test_crop_region(self):
+        x0, y0, x1, y1 = 5, 20, 61, 30
+        region = crop_region(self.header, self.decode_strips, x0, y0, x1, y1)
+        np.testing.assert_array_equal(region, self.image[:, x0:x1, y0:y1])
+        self.assertEqual(self.decoded, [1])
+
+    def test_crop_region_across_strips(self):
+        region = crop_region(self.header, self.decode_strips, 0, 10, 70, 17)
+        np.testing.assert_array_equal(region, self.image[:, :, 10:17])
+        self.assertEqual(self.decoded, [0, 1])
+
+    def test_crop_region_outside_image(self):
+        with self.assertRaises(ValueError):
+            crop_region(self.header, self.decode_strips, 0, 0, 45, 70)
+        self.assertEqual(self.decoded, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
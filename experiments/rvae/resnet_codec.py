@@ -2,7 +2,7 @@ from craystack.bb_ans import BBANS
 import craystack as cs
 
 def ResNetVAE(up_pass, rec_net_top, rec_nets, gen_net_top, gen_nets, obs_codec,
-              prior_prec, latent_prec):
+              prior_prec, latent_prec, joint_net_top=None, joint_nets=None):
     """
     Codec for a ResNetVAE.
     Assume that the posterior is bidirectional -
@@ -12,6 +12,10 @@ def ResNetVAE(up_pass, rec_net_top, rec_nets, gen_net_top, gen_nets, obs_codec,
     and in the inference network q(z_n|x, z_{n-1})
 
     Assume that everything is ordered bottom up
+
+    Optionally, joint_net_top and joint_nets compute the prior params, the posterior params and
+    the next hidden state of a layer in one step. They are used instead of the separate rec and gen
+    nets when popping from the posterior, where both are needed for every layer.
     """
     z_view = lambda head: head[0]
     x_view = lambda head: head[1]
@@ -70,20 +74,27 @@ def ResNetVAE(up_pass, rec_net_top, rec_nets, gen_net_top, gen_nets, obs_codec,
 
         def posterior_pop(message):
             # pop top-down
-            (post_mean, post_stdd), h_rec = rec_net_top(contexts[-1])
-            (prior_mean, prior_stdd), h_gen = gen_net_top()
+            if joint_net_top is None:
+                (post_mean, post_stdd), h_rec = rec_net_top(contexts[-1])
+                (prior_mean, prior_stdd), h_gen = gen_net_top()
+            else:
+                (prior_mean, prior_stdd), (post_mean, post_stdd), h_gen = joint_net_top(contexts[-1])
             codec = cs.substack(cs.DiagGaussian_GaussianBins(post_mean, post_stdd,
                                                     prior_mean, prior_stdd,
                                                     latent_prec, prior_prec),
                                  z_view)
             message, latent = codec.pop(message)
             latents = [(latent, (prior_mean, prior_stdd))]
-            for rec_net, gen_net, context in reversed(list(zip(rec_nets, gen_nets, contexts[:-1]))):
+            for i, context in reversed(list(enumerate(contexts[:-1]))):
                 previous_latent_val = prior_mean + \
                                       cs.std_gaussian_centres(prior_prec)[latents[-1][0]] * prior_stdd
 
-                (post_mean, post_stdd), h_rec = rec_net(h_rec, previous_latent_val, context)
-                (prior_mean, prior_stdd), h_gen = gen_net(h_gen, previous_latent_val)
+                if joint_nets is None:
+                    (post_mean, post_stdd), h_rec = rec_nets[i](h_rec, previous_latent_val, context)
+                    (prior_mean, prior_stdd), h_gen = gen_nets[i](h_gen, previous_latent_val)
+                else:
+                    (prior_mean, prior_stdd), (post_mean, post_stdd), h_gen = \
+                        joint_nets[i](h_gen, previous_latent_val, context)
                 codec = cs.substack(cs.DiagGaussian_GaussianBins(post_mean, post_stdd,
                                                         prior_mean, prior_stdd,
                                                         latent_prec, prior_prec),
@@ -1,6 +1,7 @@
 import re
+import shutil
+import tempfile
 import time
-from functools import lru_cache, partial
 from operator import itemgetter
 from pathlib import Path
 from time import strftime
@@ -13,10 +14,23 @@ import tensorflow as tf
 import tqdm
 from tensorflow.python.training.supervisor import Supervisor
 
-from rvae.datasets import sampling_testimage, test_image, sampling_testimages, full_imagenet
-from rvae.flif import FLIF
+from rvae.archive import read_archive, read_header, unpack_chains
+from rvae.benchmark import benchmark_byte_codecs
+from rvae.compression import VAECodecs, batch_images, batch_indices, build_layerwise_model, \
+    initial_message, partition, chunk, chain_executor, encode_chains, decode_chains, tile_image, \
+    untile_image, chain_layout, write_chains_archive, adopt_archive_header, decode_archive, \
+    unflatten_segments, compress_stream, append_to_archive, decode_newest, decode_image, \
+    crop_to_original, decode_region, decode_progressively, output_file_name, write_decoded_archive
+from rvae.datasets import sampling_testimage, test_image, sampling_testimages, full_imagenet, \
+    array_to_image_file, image_file_list, image_files_to_array
+from rvae.dedup import DuplicateIndex, with_duplicates
+from rvae.bootstrap import bootstrap_compressors, bootstrap_executor, compress_bootstrap, pop_bootstrap, \
+    push_bootstrap
 from rvae.model import CVAE1, is_eval_model_in_original_format, FLAGS
-from rvae.model.layerwise import LayerwiseCVAE, latent_shape, latent_from_image_shape, image_shape
+from rvae.model.layerwise import latent_from_image_shape
+from rvae.pipeline import ContextPrefetcher
+from rvae.regions import strip_chains
+from rvae.virtual_tail import detach_virtual_tail
 from rvae.tf_utils.common import img_stretch, img_tile
 from rvae.tf_utils.hparams import HParams
 
@@ -52,8 +66,31 @@ def get_default_hparams():
         compression_always_variable=False,
         compression_exclude_sizes=False,
         seed=0,  # seed for dataset generation
-        n_flif=5,  # number of images to compress with FLIF to start the bb chain (bbans mode)
-        initial_bits=int(1e8)  # if n_flif==0 then use a random message with this many bits
+        n_bootstrap=5,  # number of images to compress with bootstrap_codec to start the bb chain (bbans mode)
+        bootstrap_codec='flif',  # lossless codec of the bootstrap images: flif, png or webp
+        bootstrap_threads=0,  # threads compressing and decompressing bootstrap images, 0 for the default
+        initial_bits=int(1e8),  # if n_bootstrap==0, max words taken from the seeded virtual initial message
+        codec_pool_size=4,  # max number of shape-specialised codecs kept resident (bbans mode)
+        codec_pool_memory_mb=0,  # memory budget for resident codecs, 0 for no budget (bbans mode)
+        compression_polymorphic=False,  # serve all image sizes from one graph of unknown height/width
+        compression_batch_size=1,  # number of same-shape images coded per network evaluation (bbans mode)
+        compression_batch_baseline=False,  # also encode with batch size 1 and compare throughput
+        prefetch_depth=0,  # number of images whose up pass is computed ahead on a thread while encoding
+        n_chains=1,  # number of independent bits-back chains, coded in parallel processes (bbans mode)
+        compression_tile_size=512,  # size of the tiles coded as independent sub-streams (bbans_tiled mode)
+        tile_n_bootstrap=1,  # number of tiles compressed with bootstrap_codec to start each sub-stream (bbans_tiled mode)
+        dedup=False,  # store images identical to an earlier one as a reference to it (compress modes)
+        chunk_size=0,  # images per independently decodable chain, 0 for n_chains chains (compress mode)
+        stream_buffer_mb=64,  # message size held in memory before spilling to the archive (compress_stream mode)
+        flat_tiles=False,  # code nearly constant images with a flat codec instead of the VAE (bbans modes)
+        flat_max_bits=2,  # images whose channels span at most 2 ** flat_max_bits values count as flat
+        codec_dispatch=False,  # code each image with the VAE, FLIF or PNG, by predicted cost (bbans modes)
+        dispatch_bits_per_second=0.,  # bits worth paying to save a second of encoding time (codec_dispatch)
+        dispatch_vae_bpd=4.,  # VAE rate assumed before any image is coded with it (codec_dispatch)
+        dispatch_flif_bpd=4.5,  # FLIF rate assumed before any image is coded with it (codec_dispatch)
+        dispatch_vae_us_per_dim=2.,  # VAE encoding time assumed before any image is coded with it (codec_dispatch)
+        dispatch_flif_us_per_dim=.3,  # same for FLIF (codec_dispatch)
+        dispatch_png_us_per_dim=.02  # same for PNG (codec_dispatch)
     )
 
 
@@ -140,13 +177,13 @@ def images(hps):
 
         hps.eval_batch_size = 1
         hps.batch_size = 1
-        n_flif = hps.n_flif
+        n_bootstrap = hps.n_bootstrap
         tile_sizes = [32, 64, 128]
         n_ims_per_size = [4, 16, 300]
         ims = full_imagenet(hps.path, n, rng=np.random.RandomState(int(hps.seed)))
-        flif_ims = ims[:n_flif]
-        im_locations = list(range(n_flif))  # mark the actual image boundaries
-        ims = ims[n_flif:]
+        bootstrap_ims = ims[:n_bootstrap]
+        im_locations = list(range(n_bootstrap))  # mark the actual image boundaries
+        ims = ims[n_bootstrap:]
         out = []
         for n_ims, tile_size in zip(n_ims_per_size, tile_sizes):
             raw_ims = [im for im in ims[:n_ims] if im.shape[2] > tile_size and im.shape[3] > tile_size]
@@ -162,7 +199,7 @@ def images(hps):
             im_locations += [i + 1 + last_el for i in range(len(ims))]
         print('Image locations:')
         print(im_locations)
-        return None, flif_ims + sorted(out, key=lambda x: x.size, reverse=True)
+        return None, bootstrap_ims + sorted(out, key=lambda x: x.size, reverse=True)
 
     test_images_name = "test_images"
     if hps.dataset.startswith(test_images_name):
@@ -429,223 +466,103 @@ def validate_and_get_image_size(images):
     return image_dimensions
 
 
-def rvae_serial_with_progress(codecs, previous_dims):
-    def push(message, symbols):
-        init_len = 32 * len(cs.flatten(message))
-        t_start = time.time()
-        dims = previous_dims
-
-        for i, (codec, symbol) in enumerate(reversed(list(zip(codecs, symbols)))):
-            t0 = time.time()
-            message = codec.push(message, symbol)
-            dims += symbol.size
-            flat_message = cs.flatten(message)
-            print(f"Encoded {i+1}/{len(symbols)}[{(i+1)/float(len(symbols))*100:.0f}%], "
-                  f"message length: {len(flat_message) * (4/1024):.0f}kB, "
-                  f"bpd: {32 * len(flat_message) / float(dims):.2f}, "
-                  f"net bitrate: {(32 * len(flat_message) - init_len) / (float(dims - previous_dims)):.2f}, "
-                  f"net dims: {dims - previous_dims}, "
-                  f"net bits: {32 * len(flat_message) - init_len}, "
-                  f"iter time: {time.time() - t0:.2f}s, "
-                  f"total time: {time.time() - t_start:.2f}s, "
-                  f"symbol shape: {symbol.shape}, "
-                  f"message length: {len(flat_message) * (4/1024):.0f}kB, "
-                  f"bpd: {32 * len(flat_message) / float(dims):.2f}"
-                  )
-        return message
-
-    def pop(message):
-        symbols = []
-        t_start = time.time()
-        for i, codec in enumerate(codecs):
-            t0 = time.time()
-            message, symbol = codec.pop(message)
-            symbols.append(symbol)
-            print(f"Decoded {i+1}/{len(symbols)}[{(i+1)/float(len(codecs))*100:.0f}%], "
-                  f"iter time: {time.time() - t0:.2f}s, "
-                  f"total time: {time.time() - t_start:.2f}s")
-        return message, symbols
-
-    return cs.Codec(push, pop)
-
-
-def rvae_variable_size_codec(codec_from_shape, latent_from_image_shape, image_count,
-                             dimensions=4, dimension_bits=16, previous_dims=0):
-    size_codec = cs.repeat(cs.Uniform(dimension_bits), dimensions)
-
-    def push(message, symbol):
-        """push sizes and array in alternating order"""
-        assert len(symbol.shape) == dimensions
-
-        codec = codec_from_shape(symbol.shape)
-        head_size = np.prod(latent_from_image_shape(symbol.shape)) + np.prod(symbol.shape)
-        message = cs.reshape_head(message, (head_size,))
-        message = codec.push(message, symbol)
-        message = cs.reshape_head(message, (1,))
-        message = size_codec.push(message, np.array(symbol.shape))
-        return message
-
-    def pop(message):
-        message, size = size_codec.pop(message)
-        # TODO make codec 0 dimensional:
-        size = np.array(size)[:, 0]
-        assert size.shape == (dimensions,)
-        size = size.astype(np.int)
-        head_size = np.prod(latent_from_image_shape(size)) + np.prod(size)
-        codec = codec_from_shape(tuple(size))
-
-        message = cs.reshape_head(message, (head_size,))
-        message, symbol = codec.pop(message)
-        message = cs.reshape_head(message, (1,))
-
-        return message, symbol
-
-    return rvae_serial_with_progress([cs.Codec(push, pop)] * image_count, previous_dims)
-
-
-def rvae_variable_known_size_codec(codec_from_image_shape, latent_from_image_shape, shapes, previous_dims):
-    """
-    Applies given codecs in series on a sequence of symbols requiring various ANS stack head shapes.
-    The head shape required for each symbol is given through shapes.
-    """
-
-    def reshape_push(shape, message, symbol):
-        head_shape = (np.prod(latent_from_image_shape(shape)) + np.prod(shape),)
-        message = cs.reshape_head(message, head_shape)
-        codec = codec_from_image_shape(shape)
-        message = codec.push(message, symbol)
-        return message
-
-    def reshape_pop(shape, message):
-        head_shape = (np.prod(latent_from_image_shape(shape)) + np.prod(shape),)
-        message = cs.reshape_head(message, head_shape)
-        codec = codec_from_image_shape(shape)
-        message, symbol = codec.pop(message)
-        return message, symbol
-
-    return rvae_serial_with_progress([
-        cs.Codec(partial(reshape_push, shape), partial(reshape_pop, shape))
-        for shape in shapes], previous_dims)
-
-
-def run_bbans(hps):
-    from autograd.builtins import tuple as ag_tuple
-    from rvae.resnet_codec import ResNetVAE
-
+def compression_images(hps):
+    """The images of hps.dataset as a list of chw uint64 arrays, coded one by one."""
     hps.num_gpus = 1
     hps.batch_size = 1
-    batch_size = hps.batch_size
-    hps.eval_batch_size = batch_size
-    n_flif = hps.n_flif
+    hps.eval_batch_size = 1
 
     _, datasets = images(hps)
     datasets = datasets if isinstance(datasets, list) else [datasets]
-    test_images = [np.array([image]).astype('uint64')
-                   for dataset in datasets for image in dataset]
-    n_batches = len(test_images) // batch_size
-    test_images = [np.concatenate(test_images[i*batch_size:(i+1)*batch_size], axis=0)
-                   for i in range(n_batches)]
-    flif_images = test_images[:n_flif]
-    vae_images = test_images[n_flif:]
-    num_dims = np.sum([batch.size for batch in test_images])
-    flif_dims = np.sum([batch.size for batch in flif_images]) if flif_images else 0
-
-    prior_precision = 10
-    obs_precision = 24
-    q_precision = 18
-
-    @lru_cache(maxsize=1)
-    def codec_from_shape(shape):
-        print("Creating codec for shape " + str(shape))
-
-        hps.image_size = (shape[2], shape[3])
-
-        z_shape = latent_shape(hps)
-        z_size = np.prod(z_shape)
-
-        graph = tf.Graph()
-        with graph.as_default():
-            with tf.variable_scope("model", reuse=tf.AUTO_REUSE):
-                x = tf.placeholder(tf.float32, shape, 'x')
-                model = CVAE1(hps, "eval", x)
-                stepwise_model = LayerwiseCVAE(model)
+    return [np.array(image).astype('uint64') for dataset in datasets for image in dataset]
 
-        saver = tf.train.Saver(model.avg_dict)
-        config = tf.ConfigProto(allow_soft_placement=True,
-                                intra_op_parallelism_threads=4,
-                                inter_op_parallelism_threads=4)
-        sess = tf.Session(config=config, graph=graph)
-        saver.restore(sess, restore_path())
-
-        run_all_contexts, run_top_prior, runs_down_prior, run_top_posterior, runs_down_posterior, \
-        run_reconstruction = stepwise_model.get_model_parts_as_numpy_functions(sess)
-
-        # Setup codecs
-        def vae_view(head):
-            return ag_tuple((np.reshape(head[:z_size], z_shape),
-                             np.reshape(head[z_size:], shape)))
-
-        obs_codec = lambda h, z1: cs.Logistic_UnifBins(*run_reconstruction(h, z1),
-                                                       obs_precision, bin_prec=8,
-                                                       bin_lb=-0.5, bin_ub=0.5)
-
-        return cs.substack(
-            ResNetVAE(run_all_contexts,
-                      run_top_posterior, runs_down_posterior,
-                      run_top_prior, runs_down_prior,
-                      obs_codec, prior_precision, q_precision),
-            vae_view)
-
-    is_fixed = not hps.compression_always_variable and \
-               (len(set([dataset[0].shape[-2:] for dataset in datasets])) == 1)
-    fixed_size_codec = lambda: cs.repeat(codec_from_shape(vae_images[0].shape), len(vae_images))
-    variable_codec_including_sizes = lambda: rvae_variable_size_codec(codec_from_shape,
-                                                                      latent_from_image_shape=latent_from_image_shape(
-                                                                          hps),
-                                                                      image_count=len(vae_images),
-                                                                      previous_dims=flif_dims)
-    variable_known_sizes_codec = lambda: rvae_variable_known_size_codec(
-        codec_from_image_shape=codec_from_shape,
-        latent_from_image_shape=latent_from_image_shape(hps),
-        shapes=[i.shape for i in vae_images],
-        previous_dims=flif_dims)
-    variable_size_codec = \
-        variable_known_sizes_codec if hps.compression_exclude_sizes else variable_codec_including_sizes
-    codec = fixed_size_codec if is_fixed else variable_size_codec
-    vae_push, vae_pop = codec()
-
-    np.seterr(divide='raise')
-
-    if n_flif:
-        print('Using FLIF to encode initial images...')
-        flif_push, flif_pop = cs.repeat(cs.repeat(FLIF, batch_size), n_flif)
-        message = cs.empty_message((1,))
-        message = flif_push(message, flif_images)
-    else:
-        print('Creating a random initial message...')
-        message = cs.random_message(hps.initial_bits, (1,))
 
-    init_head_shape = (np.prod(image_shape(hps)) + np.prod(latent_shape(hps)) if is_fixed else 1,)
+def run_bbans(hps):
+    n_bootstrap = hps.n_bootstrap
+    test_images = compression_images(hps)
+    if hps.n_chains > 1:
+        return run_bbans_chains(hps, test_images)
+
+    bootstrap_images = [np.array([image]) for image in test_images[:n_bootstrap]]
+    vae_images = batch_images(test_images[n_bootstrap:], hps.compression_batch_size)
+    num_dims = np.sum([image.size for image in test_images])
+    bootstrap_dims = np.sum([batch.size for batch in bootstrap_images]) if bootstrap_images else 0
+
+    checkpoint = restore_path()
+    bootstrap_t0 = time.time()
+    with bootstrap_executor(hps.bootstrap_threads) as executor:
+        # the bootstrap images are compressed while the graph is built and the checkpoint restored
+        compressed = compress_bootstrap(hps.bootstrap_codec, bootstrap_images, executor)
+        codecs = VAECodecs(hps, checkpoint)
+        vae_shapes = [batch.shape for batch in vae_images]
+        (vae_push, vae_pop), init_head_shape = codecs.serial_codec(vae_shapes, bootstrap_dims)
+        codecs.build_first(vae_shapes)
+
+        np.seterr(divide='raise')
+
+        message = initial_message(hps, bootstrap_images, compressed=compressed)
+    print("Bootstrap and model construction took {:.2f}s".format(time.time() - bootstrap_t0))
+    initial = message
     message = cs.reshape_head(message, init_head_shape)
 
+    if hps.prefetch_depth:
+        # images are pushed last to first
+        codecs.context_prefetcher = ContextPrefetcher(codecs.try_up_pass, reversed(vae_images),
+                                                      hps.prefetch_depth)
+
     print("Encoding with VAE...")
     encode_t0 = time.time()
     message = vae_push(message, vae_images)
     encode_t = time.time() - encode_t0
     print("All encoded in {:.2f}s".format(encode_t))
-
+    if codecs.context_prefetcher is not None:
+        codecs.context_prefetcher.close()
+        codecs.context_prefetcher.report()
+        codecs.context_prefetcher = None
+    vae_image_count = sum(len(batch) for batch in vae_images)
+    print("Batch size {}: {:.2f} images/s, {:.4f} bits per dim.".format(
+        hps.compression_batch_size, vae_image_count / encode_t,
+        32 * len(cs.flatten(message)) / num_dims))
+
+    if hps.compression_batch_baseline and hps.compression_batch_size > 1:
+        print("Encoding with VAE at batch size 1 for comparison...")
+        single_images = batch_images([image for batch in vae_images for image in batch], 1)
+        (single_push, _), single_head_shape = codecs.serial_codec(
+            [batch.shape for batch in single_images], bootstrap_dims)
+        baseline_t0 = time.time()
+        baseline_message = single_push(cs.reshape_head(initial, single_head_shape), single_images)
+        baseline_t = time.time() - baseline_t0
+        print("Batch size 1: {:.2f} images/s, {:.4f} bits per dim.".format(
+            vae_image_count / baseline_t, 32 * len(cs.flatten(baseline_message)) / num_dims))
+        print("Speedup from batching: {:.2f}x".format(baseline_t / encode_t))
+
+    message, consumed = detach_virtual_tail(message)
     flat_message = cs.flatten(message)
     message_len = 32 * len(flat_message)
     print("Used {} bits.".format(message_len))
     print("This is {:.2f} bits per dim.".format(message_len / num_dims))
-    if n_flif == 0:
-        extra_bits = message_len - 32 * hps.initial_bits
-        print('Extra bits: {}'.format(extra_bits))
-        print('This is {:.2f} bits per dim.'.format(extra_bits / num_dims))
+    if consumed is not None:
+        print('Bits taken from the virtual initial message: {}'.format(32 * consumed))
+        print('This is {:.2f} bits per dim.'.format(32 * consumed / num_dims))
+
+    if FLAGS.archive:
+        vae_indices = batch_indices([image.shape for image in test_images[n_bootstrap:]],
+                                    hps.compression_batch_size)
+        layout = chain_layout(init_head_shape, [batch.shape for batch in vae_images],
+                              len(bootstrap_images), vae_indices)
+        if consumed is not None:
+            layout['virtual_tail'] = [int(hps.seed), consumed]
+        write_chains_archive(FLAGS.archive, hps, checkpoint, [flat_message], [layout])
+        print(f"Wrote {FLAGS.archive} ({os.path.getsize(FLAGS.archive)} bytes).")
+        header, (segments,) = read_archive(FLAGS.archive)
+        adopt_archive_header(hps, checkpoint, header)
+    else:
+        segments = [flat_message]
 
     print('Decoding with VAE...')
     decode_t0 = time.time()
-    message = cs.unflatten(flat_message, init_head_shape)
+    message = unflatten_segments(segments, init_head_shape,
+                                 None if consumed is None else [int(hps.seed), consumed])
     message, decoded_vae_images = vae_pop(message)
     message = cs.reshape_head(message, (1,))
 
@@ -656,11 +573,415 @@ def run_bbans(hps):
     for test_image, decoded_image in zip(vae_images, decoded_vae_images):
         np.testing.assert_equal(test_image, decoded_image)
 
-    if n_flif:
-        print('Decoding with FLIF...')
-        message, decoded_flif_images = flif_pop(message)
-        for test_image, decoded_image in zip(flif_images, decoded_flif_images):
+    if n_bootstrap:
+        bootstrap_t0 = time.time()
+        with bootstrap_executor(hps.bootstrap_threads) as executor:
+            message, decoded_bootstrap_images = pop_bootstrap(hps.bootstrap_codec, message, n_bootstrap,
+                                                              executor)
+            for test_image, decoded_image in zip(bootstrap_images, decoded_bootstrap_images):
+                np.testing.assert_equal(test_image, [decoded_image.result()])
+        print('Bootstrap decoded in {:.2f}s'.format(time.time() - bootstrap_t0))
+        assert cs.is_empty(message)
+
+    codecs.close()
+
+
+def run_bbans_chains(hps, test_images):
+    """Codes the images as hps.n_chains independent bits-back chains, in parallel worker processes."""
+    chains = partition(test_images, hps.n_chains)
+    n_chains = len(chains)
+    num_dims = np.sum([image.size for image in test_images])
+    checkpoint = restore_path()
+    print(f"Coding {len(test_images)} images in {n_chains} chains of "
+          f"{', '.join(str(len(chain)) for chain in chains)} images...")
+
+    with chain_executor(n_chains) as executor:
+        encode_t0 = time.time()
+        archive, layouts = encode_chains(executor, hps, checkpoint, chains)
+        print("All encoded in {:.2f}s".format(time.time() - encode_t0))
+        message_len = 32 * len(archive)
+        print("Used {} bits.".format(message_len))
+        print("This is {:.2f} bits per dim.".format(message_len / num_dims))
+
+        decode_t0 = time.time()
+        if FLAGS.archive:
+            write_chains_archive(FLAGS.archive, hps, checkpoint, unpack_chains(archive), layouts)
+            print(f"Wrote {FLAGS.archive} ({os.path.getsize(FLAGS.archive)} bytes).")
+            decoded = decode_archive(executor, hps, checkpoint, FLAGS.archive)
+        else:
+            decoded = decode_chains(executor, hps, checkpoint, archive, layouts)
+        print('All decoded in {:.2f}s'.format(time.time() - decode_t0))
+
+    for chain, decoded_chain in zip(chains, decoded):
+        assert len(chain) == len(decoded_chain), (len(chain), len(decoded_chain))
+        for test_image, decoded_image in zip(chain, decoded_chain):
             np.testing.assert_equal(test_image, decoded_image)
+
+
+def run_bbans_tiled(hps):
+    """
+    Codes each image on its own, cut into tiles of compression_tile_size pixels which are split into
+    n_chains independent sub-streams, coded in parallel worker processes. Each sub-stream is
+    bootstrapped with bootstrap_codec on its first tile_n_bootstrap tiles.
+    """
+    hps.n_bootstrap = hps.tile_n_bootstrap
+    test_images = compression_images(hps)
+    checkpoint = restore_path()
+
+    with chain_executor(hps.n_chains) as executor:
+        for index, image in enumerate(test_images):
+            tiles, grid = tile_image(image, hps.compression_tile_size)
+            chains = partition(tiles, hps.n_chains)
+            print(f"Image {index} of shape {image.shape}: {len(tiles)} tiles ({grid[0]}x{grid[1]}) "
+                  f"in {len(chains)} sub-streams...")
+
+            encode_t0 = time.time()
+            archive, layouts = encode_chains(executor, hps, checkpoint, chains)
+            encode_t = time.time() - encode_t0
+            # the chain index at the front of the archive is the offset table of the sub-streams
+            message_len = 32 * len(archive)
+
+            decode_t0 = time.time()
+            decoded = decode_chains(executor, hps, checkpoint, archive, layouts)
+            decode_t = time.time() - decode_t0
+
+            np.testing.assert_equal(image, untile_image([tile for chain in decoded for tile in chain], grid))
+            print(f"Image {index}: {message_len / image.size:.4f} bits per dim, "
+                  f"encoded in {encode_t:.2f}s, decoded in {decode_t:.2f}s")
+
+
+def run_compress(hps):
+    """Compresses the images of hps.dataset into the archive file given by --archive."""
+    assert FLAGS.archive, "compress mode needs an --archive path to write to"
+    test_images = compression_images(hps)
+    coded_images, header_fields = test_images, {}
+    if hps.dedup:
+        duplicates = DuplicateIndex()
+        coded_images = [image for i, image in enumerate(test_images) if duplicates.add(i, image) is None]
+        header_fields = dict(image_count=len(test_images), duplicates=duplicates.header_references())
+    if hps.chunk_size:
+        # the shapes are stored in the index, so they need not be coded
+        hps.compression_exclude_sizes = True
+        chains = chunk(coded_images, hps.chunk_size)
+    else:
+        chains = partition(coded_images, hps.n_chains)
+    checkpoint = restore_path()
+    num_dims = np.sum([image.size for image in test_images])
+
+    with chain_executor(min(hps.n_chains, len(chains))) as executor:
+        t0 = time.time()
+        archive, layouts = encode_chains(executor, hps, checkpoint, chains)
+        write_chains_archive(FLAGS.archive, hps, checkpoint, unpack_chains(archive), layouts,
+                             **header_fields)
+        encode_t = time.time() - t0
+
+    print(f"Compressed {len(test_images)} images in {len(chains)} chains into {FLAGS.archive} in "
+          f"{encode_t:.2f}s ({len(test_images) / encode_t:.2f} images/s, "
+          f"{num_dims / encode_t / 1e6:.2f}M dims/s).")
+    print(f"Archive size: {os.path.getsize(FLAGS.archive)} bytes, "
+          f"{8 * os.path.getsize(FLAGS.archive) / num_dims:.4f} bits per dim.")
+    if hps.dedup:
+        duplicates.report(encode_t / np.sum([image.size for image in coded_images]))
+    bootstrap_words = sum(layout['bootstrap_words'] for layout in layouts)
+    print(f"Bootstrap of the chains: {bootstrap_words} words, "
+          f"{32 * bootstrap_words / num_dims:.4f} bits per dim.")
+    virtual_words = sum(layout['virtual_tail'][1] for layout in layouts if 'virtual_tail' in layout)
+    if virtual_words:
+        print(f"Words taken from virtual initial messages: {virtual_words}, "
+              f"{32 * virtual_words / num_dims:.4f} bits per dim.")
+
+
+def run_compress_regions(hps):
+    """
+    Compresses the first image of hps.dataset into the archive file given by --archive, as
+    horizontal strips of compression_tile_size pixels that are coded as separate chains, so that
+    regions can be decoded with --region without decoding the whole image.
+    """
+    assert FLAGS.archive, "compress_regions mode needs an --archive path to write to"
+    hps.n_bootstrap = hps.tile_n_bootstrap
+    image = compression_images(hps)[0]
+    chains, strips = strip_chains(image, hps.compression_tile_size)
+    checkpoint = restore_path()
+
+    with chain_executor(min(hps.n_chains, len(chains))) as executor:
+        t0 = time.time()
+        archive, layouts = encode_chains(executor, hps, checkpoint, chains)
+        write_chains_archive(FLAGS.archive, hps, checkpoint, unpack_chains(archive), layouts,
+                             image_shape=[int(d) for d in image.shape], strips=strips)
+        encode_t = time.time() - t0
+
+    print(f"Compressed an image of shape {image.shape} in {len(chains)} strips into {FLAGS.archive} "
+          f"in {encode_t:.2f}s, {8 * os.path.getsize(FLAGS.archive) / image.size:.4f} bits per dim.")
+
+
+def run_compress_stream(hps):
+    """
+    Compresses the image files given by --input (a directory, or a text file listing one path per
+    line) into the archive file given by --archive, loading and coding one image at a time.
+    """
+    assert FLAGS.archive and FLAGS.input, "compress_stream mode needs --input and --archive paths"
+    hps.num_gpus = 1
+    files = image_file_list(FLAGS.input)
+    print(f"Compressing {len(files)} images from {FLAGS.input}...")
+
+    t0 = time.time()
+    compress_stream(hps, restore_path(), files, FLAGS.archive,
+                    lambda f: image_files_to_array([f], max_pixels=None)[0].astype('uint64'))
+    encode_t = time.time() - t0
+    print(f"Compressed {len(files)} images into {FLAGS.archive} in {encode_t:.2f}s "
+          f"({len(files) / encode_t:.2f} images/s), "
+          f"archive size: {os.path.getsize(FLAGS.archive)} bytes.")
+
+
+def run_append(hps):
+    """Pushes the image files given by --input onto the archive file given by --archive."""
+    assert FLAGS.archive and FLAGS.input, "append mode needs --input and --archive paths"
+    hps.num_gpus = 1
+    files = image_file_list(FLAGS.input)
+    size = os.path.getsize(FLAGS.archive)
+    print(f"Appending {len(files)} images from {FLAGS.input} to {FLAGS.archive}...")
+
+    t0 = time.time()
+    header = append_to_archive(hps, restore_path(), FLAGS.archive, files,
+                               lambda f: image_files_to_array([f], max_pixels=None)[0].astype('uint64'))
+    print(f"Appended {len(files)} images in {time.time() - t0:.2f}s, the archive now holds "
+          f"{header['image_count']} images, {os.path.getsize(FLAGS.archive) - size} bytes were added.")
+
+
+def decompress(hps):
+    """Decodes the archive file given by --archive, returns its images in their original order."""
+    assert FLAGS.archive, "decompress mode needs an --archive path to read from"
+    hps.num_gpus = 1
+    header, _ = read_header(FLAGS.archive)
+    checkpoint = restore_path()
+
+    with chain_executor(min(len(header['chains']), os.cpu_count())) as executor:
+        t0 = time.time()
+        decoded = decode_archive(executor, hps, checkpoint, FLAGS.archive)
+        decode_t = time.time() - t0
+
+    decoded_images = with_duplicates(header, [image for chain in decoded for image in chain])
+    decoded_images = [crop_to_original(header, i, image) for i, image in enumerate(decoded_images)]
+    num_dims = np.sum([image.size for image in decoded_images])
+    print(f"Decompressed {len(decoded_images)} images from {FLAGS.archive} in {decode_t:.2f}s "
+          f"({len(decoded_images) / decode_t:.2f} images/s, {num_dims / decode_t / 1e6:.2f}M dims/s).")
+    return decoded_images
+
+
+def decompress_to_files(hps, output):
+    """Decodes the archive file given by --archive into the directory output, with the chains
+    decoded in parallel and each worker writing the images of its chain as soon as they are popped,
+    so that decoded images are not kept in memory."""
+    assert FLAGS.archive, "decompress mode needs an --archive path to read from"
+    hps.num_gpus = 1
+    header, _ = read_header(FLAGS.archive)
+    output.mkdir(parents=True, exist_ok=True)
+
+    with chain_executor(min(len(header['chains']), os.cpu_count())) as executor:
+        t0 = time.time()
+        n_images, num_dims = write_decoded_archive(executor, hps, restore_path(), FLAGS.archive, output)
+        decode_t = time.time() - t0
+
+    print(f"Decompressed {n_images} images from {FLAGS.archive} to {output} in {decode_t:.2f}s "
+          f"({n_images / decode_t:.2f} images/s, {num_dims / decode_t / 1e6:.2f}M dims/s).")
+
+
+def decompress_newest(hps, count):
+    """Decodes only the count images added last to the archive file given by --archive."""
+    hps.num_gpus = 1
+    t0 = time.time()
+    ids, decoded_images = decode_newest(hps, restore_path(), FLAGS.archive, count)
+    header, _ = read_header(FLAGS.archive)
+    decoded_images = [crop_to_original(header, i, image) for i, image in zip(ids, decoded_images)]
+    print(f"Decompressed the newest {len(decoded_images)} images from {FLAGS.archive} "
+          f"in {time.time() - t0:.2f}s.")
+    return ids, decoded_images
+
+
+def decompress_images(hps, image_ids):
+    """Decodes single images of the archive file given by --archive, printing the latency of each."""
+    hps.num_gpus = 1
+    checkpoint = restore_path()
+    header, _ = read_header(FLAGS.archive)
+    decoded_images = []
+    for image_id in image_ids:
+        t0 = time.time()
+        image = decode_image(hps, checkpoint, FLAGS.archive, image_id)
+        decoded_images.append(crop_to_original(header, image_id, image))
+        print(f"Decompressed image {image_id} from {FLAGS.archive} in {time.time() - t0:.2f}s.")
+    return image_ids, decoded_images
+
+
+def run_decompress(hps):
+    """
+    Decodes the archive file given by --archive, or with --newest k only the k images added last,
+    or with --image_ids only the given images, or with --region only a window of an image
+    compressed in compress_regions mode, and writes the images to --output if given.
+    """
+    if FLAGS.region:
+        x0, y0, x1, y1 = [int(c) for c in FLAGS.region.split(',')]
+        t0 = time.time()
+        with chain_executor(hps.n_chains) as executor:
+            region = decode_region(hps, restore_path(), FLAGS.archive, x0, y0, x1, y1, executor)
+        print(f"Decompressed region ({x0}, {y0}, {x1}, {y1}) from {FLAGS.archive} "
+              f"in {time.time() - t0:.2f}s.")
+        decoded = [(f"region_{x0}_{y0}_{x1}_{y1}", region)]
+    elif FLAGS.newest:
+        decoded = zip(*decompress_newest(hps, FLAGS.newest))
+    elif FLAGS.image_ids:
+        decoded = zip(*decompress_images(hps, [int(i) for i in FLAGS.image_ids.split(',')]))
+    elif FLAGS.output:
+        decompress_to_files(hps, Path(FLAGS.output))
+        return
+    else:
+        decompress(hps)
+        return
+
+    if FLAGS.output:
+        output = Path(FLAGS.output)
+        output.mkdir(parents=True, exist_ok=True)
+        header, _ = read_header(FLAGS.archive)
+        n_images = 0
+        for i, image in decoded:
+            name = f"{i}.png" if isinstance(i, str) else output_file_name(header, i)
+            array_to_image_file(image, output / name)
+            n_images += 1
+        print(f"Wrote {n_images} images to {output}.")
+
+
+def run_preview(hps):
+    """
+    Decodes the archive file given by --archive, writing a preview of each VAE-coded image to
+    --output as soon as its latents are popped, and every image once its pixels are, named by
+    output_file_name.
+    """
+    assert FLAGS.archive and FLAGS.output, "preview mode needs --archive and --output paths"
+    hps.num_gpus = 1
+    output = Path(FLAGS.output)
+    output.mkdir(parents=True, exist_ok=True)
+    header, _ = read_header(FLAGS.archive)
+    counts = {'preview': 0, 'image': 0}
+    t0 = time.time()
+    for kind, image_id, image in decode_progressively(hps, restore_path(), FLAGS.archive):
+        name = Path(output_file_name(header, image_id))
+        if kind == 'preview':
+            name = name.with_name(f"{name.stem}_preview{name.suffix}")
+        array_to_image_file(image, output / name)
+        counts[kind] += 1
+        print(f"{kind.capitalize()} of image {image_id} after {time.time() - t0:.2f}s "
+              f"({counts['preview']} previews, {counts['image']} images).")
+
+
+def run_verify(hps):
+    """Decodes the archive file given by --archive and checks it against the image files it was
+    compressed from, or if they are not recorded, against the images of hps.dataset."""
+    decoded_images = decompress(hps)
+    files = read_header(FLAGS.archive)[0].get('files')
+    test_images = [image_files_to_array([f], max_pixels=None)[0].astype('uint64') for f in files] \
+        if files else compression_images(hps)
+    assert len(test_images) == len(decoded_images), (len(test_images), len(decoded_images))
+    for test_image, decoded_image in zip(test_images, decoded_images):
+        np.testing.assert_equal(test_image, decoded_image)
+    print(f"Verified {len(decoded_images)} images.")
+
+
+def run_layer_benchmark(hps, image_sizes=((32, 32), (256, 256)), repeats=20):
+    """Per-call latency of the layerwise model parts, with sess.run and with precompiled callables."""
+    hps.num_gpus = 1
+    hps.batch_size = 1
+    hps.eval_batch_size = 1
+    rng = np.random.RandomState(int(hps.seed))
+
+    print('image size, method, part, latency/ms')
+    for size in image_sizes:
+        shape = (1, 3, *size)
+        stepwise_model, sess = build_layerwise_model(hps, shape, restore_path())
+        x = rng.randint(256, size=shape)
+        z = rng.randn(*latent_from_image_shape(hps)(shape))
+
+        for precompiled in [False, True]:
+            run_all_contexts, run_top_prior, runs_down_prior, run_top_posterior, runs_down_posterior, \
+            run_reconstruction = stepwise_model.get_model_parts_as_numpy_functions(sess, shape,
+                                                                                  precompiled)
+            _, runs_down_prior_and_posterior = \
+                stepwise_model.get_fused_parts_as_numpy_functions(sess, precompiled)
+            contexts = run_all_contexts(x)
+            _, h = run_top_posterior(contexts[-1])
+            parts = {
+                'all contexts': lambda: run_all_contexts(x),
+                'top prior': run_top_prior,
+                'down prior': lambda: runs_down_prior[-1](h, z),
+                'down posterior': lambda: runs_down_posterior[-1](h, z, contexts[0]),
+                'down prior and posterior': lambda: runs_down_prior_and_posterior[-1](h, z, contexts[0]),
+                'reconstruction': lambda: run_reconstruction(h, z)
+            }
+            for name, part in parts.items():
+                part()  # warm up
+                t0 = time.time()
+                for _ in range(repeats):
+                    part()
+                latency = (time.time() - t0) / repeats
+                print(f"{size[0]}x{size[1]}, {'make_callable' if precompiled else 'sess.run'}, "
+                      f"{name}, {latency * 1000:.2f}")
+        sess.close()
+
+
+def run_chunk_benchmark(hps):
+    """
+    Bootstrap overhead against random-access latency: compresses the images of hps.dataset in
+    chunks of each of --chunk_sizes, and prints the bits per dim of the bootstraps and the latency
+    of decoding single images of the first chunk with decode_image.
+    """
+    test_images = compression_images(hps)
+    # as in compress mode with chunk_size
+    hps.compression_exclude_sizes = True
+    hps.num_gpus = 1
+    checkpoint = restore_path()
+    num_dims = np.sum([image.size for image in test_images])
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'archive')
+        for chunk_size in [int(n) for n in FLAGS.chunk_sizes.split(',')]:
+            chains = chunk(test_images, chunk_size)
+            with chain_executor(min(hps.n_chains, len(chains))) as executor:
+                archive, layouts = encode_chains(executor, hps, checkpoint, chains)
+            write_chains_archive(path, hps, checkpoint, unpack_chains(archive), layouts)
+            bootstrap_words = sum(layout['bootstrap_words'] for layout in layouts)
+
+            image_ids = sorted(set(np.linspace(0, len(chains[0]) - 1, 8).astype(int)))
+            # the image pushed last is popped first, this builds the codecs before timing
+            decode_image(hps, checkpoint, path, len(chains[0]) - 1)
+            latencies = []
+            for image_id in image_ids:
+                t0 = time.time()
+                decode_image(hps, checkpoint, path, int(image_id))
+                latencies.append(time.time() - t0)
+            print(f"Chunk size {chunk_size}: {8 * os.path.getsize(path) / num_dims:.4f} bits per dim, "
+                  f"bootstrap {32 * bootstrap_words / num_dims:.4f} bits per dim, "
+                  f"single image latency {np.mean(latencies):.2f}s on average, {np.max(latencies):.2f}s "
+                  f"at most over images {', '.join(str(i) for i in image_ids)}.")
+
+
+def run_bytes_benchmark(hps):
+    """Push and pop time of the byte codec of the FLIF bootstrap, against pushing byte by byte."""
+    benchmark_byte_codecs(seed=int(hps.seed))
+
+
+def run_bootstrap_benchmark(hps):
+    """Time and rate of each bootstrap codec on the first n_bootstrap images of the dataset."""
+    bootstrap_images = [np.array([image]) for image in compression_images(hps)[:max(hps.n_bootstrap, 1)]]
+    for name in bootstrap_compressors:
+        if name == 'flif' and shutil.which('flif') is None:
+            print("Skipping flif, the flif binary is not installed.")
+            continue
+        with bootstrap_executor(hps.bootstrap_threads) as executor:
+            compressed = compress_bootstrap(name, bootstrap_images, executor)
+            message = push_bootstrap(name, cs.empty_message((1,)), bootstrap_images, compressed)
+            t0 = time.time()
+            message, decoded_images = pop_bootstrap(name, message, len(bootstrap_images), executor)
+            for image, decoded_image in zip(bootstrap_images, decoded_images):
+                np.testing.assert_equal(image, [decoded_image.result()])
+            print(f"Bootstrap with {name}: decoded in {time.time() - t0:.2f}s")
         assert cs.is_empty(message)
 
 
@@ -668,7 +989,12 @@ def main(_):
     hps = get_default_hparams().parse(FLAGS.hpconfig)
     print(hps)
 
-    fun = {"train": run, "eval": run_eval, "bbans": run_bbans}
+    fun = {"train": run, "eval": run_eval, "bbans": run_bbans, "bbans_tiled": run_bbans_tiled,
+           "compress": run_compress, "compress_stream": run_compress_stream, "append": run_append,
+           "compress_regions": run_compress_regions,
+           "decompress": run_decompress, "preview": run_preview, "verify": run_verify,
+           "benchmark_layers": run_layer_benchmark, "benchmark_chunks": run_chunk_benchmark,
+           "benchmark_bytes": run_bytes_benchmark, "benchmark_bootstrap": run_bootstrap_benchmark}
 
     fun[FLAGS.mode](hps)
 
@@ -73,10 +73,18 @@ def conv2d(name, x, num_filters, filter_size=(3, 3), stride=(1, 1), pad="SAME",
 
 def my_deconv2d(x, filters, strides):
     input_shape = x.get_shape()
-    output_shape = [int(input_shape[0]), int(filters.get_shape()[2]),
-                    int(input_shape[2] * strides[2]), int(input_shape[3] * strides[3])]
+    if input_shape.is_fully_defined():
+        output_shape = [int(input_shape[0]), int(filters.get_shape()[2]),
+                        int(input_shape[2] * strides[2]), int(input_shape[3] * strides[3])]
+    else:
+        # unknown image size, derive the output shape at run time
+        dynamic_shape = tf.shape(x)
+        output_shape = [dynamic_shape[0], int(filters.get_shape()[2]),
+                        dynamic_shape[2] * strides[2], dynamic_shape[3] * strides[3]]
     x = tf.transpose(x, (0, 2, 3, 1))  # go to NHWC data layout
     output_shape = [output_shape[0], output_shape[2], output_shape[3], output_shape[1]]
+    if not input_shape.is_fully_defined():
+        output_shape = tf.stack(output_shape)
     strides = [strides[0], strides[2], strides[3], strides[1]]
     x = tf.nn.conv2d_transpose(x, filters, output_shape=output_shape, strides=strides, padding="SAME")
     x = tf.transpose(x, (0, 3, 1, 2))  # back to NCHW
@@ -0,0 +1,86 @@
+"""
+Seeded virtual bottom of an ANS message, standing in for a message of random words to start a
+bits-back chain. Words are generated from the seed as they are popped, instead of being allocated
+up front, and they are not part of the flattened message: cs.flatten and the other walks of a tail
+stop at a VirtualTail, which is falsy, while popping unpacks it as a (words, rest) node.
+"""
+
+import craystack as cs
+import numpy as np
+
+chunk_words = 1 << 12
+
+
+def virtual_words(seed, position):
+    """Words from position up to the end of its chunk. Chunks are seeded separately, so that any
+    position can be generated without the words before it."""
+    index, start = divmod(position, chunk_words)
+    words = np.random.RandomState([seed, index]).randint(1 << 32, size=chunk_words, dtype=np.uint32)
+    return words[start:]
+
+
+class VirtualTail:
+    """Tail of the words generated from seed, from position on. At most limit words can be popped."""
+
+    def __init__(self, seed, position=0, limit=None):
+        self.seed = int(seed)
+        self.position = int(position)
+        self.limit = limit
+        self.above = None  # the words generated just before position, if this node was unpacked
+
+    def __bool__(self):
+        return False
+
+    def __iter__(self):
+        if self.limit is not None and self.position >= self.limit:
+            raise ValueError(f"Virtual initial message exhausted after {self.limit} words, "
+                             f"raise initial_bits or use n_bootstrap > 0")
+        words = virtual_words(self.seed, self.position)
+        if self.limit is not None:
+            words = words[:self.limit - self.position]
+        rest = VirtualTail(self.seed, self.position + len(words), self.limit)
+        rest.above = words
+        return iter((words, rest))
+
+
+def virtual_message(seed, shape=(1,), limit=None):
+    """Empty message on top of a VirtualTail, in place of cs.random_message."""
+    head, _ = cs.empty_message(shape)
+    return head, VirtualTail(seed, limit=limit)
+
+
+def detach_virtual_tail(message):
+    """
+    Splits message into the message of its stored words and the number of words of its virtual
+    tail that were consumed, which is None if it has no virtual tail. Generated words left over
+    just above the virtual tail are dropped, as they can be generated again.
+    """
+    head, tail = message
+    nodes = []
+    while tail:
+        node, tail = tail
+        nodes.append(node)
+    if not isinstance(tail, VirtualTail):
+        return message, None
+    consumed = tail.position
+    # a pop that takes part of a generated node leaves its suffix as a node of its own
+    if nodes and tail.above is not None and np.shares_memory(nodes[-1], tail.above):
+        consumed -= len(nodes.pop())
+    return (head, attach(nodes, ())), consumed
+
+
+def attach_virtual_tail(message, seed, consumed, limit=None):
+    """Inverse of detach_virtual_tail, given the seed of the virtual tail."""
+    head, tail = message
+    nodes = []
+    while tail:
+        node, tail = tail
+        nodes.append(node)
+    return head, attach(nodes, VirtualTail(seed, consumed, limit))
+
+
+def attach(nodes, bottom):
+    """Tail of the given nodes, top first, on top of bottom."""
+    for node in reversed(nodes):
+        bottom = node, bottom
+    return bottom
@@ -0,0 +1,65 @@
+import unittest
+
+import craystack as cs
+import numpy as np
+
+from rvae.virtual_tail import attach_virtual_tail, chunk_words, detach_virtual_tail, virtual_message, \
+    virtual_words
+
+
+class VirtualTailTestCase(unittest.TestCase):
+    seed = 3
+    shape = (8,)
+    limit = 4 * chunk_words
+    codec = cs.Uniform(16)
+
+    def pop(self, message, n):
+        symbols = []
+        for _ in range(n):
+            message, symbol = self.codec.pop(message)
+            symbols.append(np.array(symbol))
+        return message, symbols
+
+    def reattached(self, message):
+        """message after storing it as archives do, without its virtual tail, and loading it back."""
+        stored, consumed = detach_virtual_tail(message)
+        restored = cs.unflatten(cs.flatten(stored), self.shape)
+        return attach_virtual_tail(restored, self.seed, consumed, self.limit)
+
+    def assert_same_pops(self, message, other, n):
+        message, symbols = self.pop(message, n)
+        other, other_symbols = self.pop(other, n)
+        np.testing.assert_array_equal(symbols, other_symbols)
+        np.testing.assert_array_equal(cs.flatten(message), cs.flatten(other))
+
+    def test_virtual_words(self):
+        position = chunk_words + 5
+        np.testing.assert_array_equal(virtual_words(self.seed, position),
+                                      virtual_words(self.seed, chunk_words)[5:])
+
+    def test_reattach_after_partial_chunk(self):
+        message, _ = self.pop(virtual_message(self.seed, self.shape, self.limit), 10)
+        stored, consumed = detach_virtual_tail(message)
+        self.assertLess(0, consumed)
+        self.assertLess(consumed, chunk_words)
+        # the words generated but not popped are not stored
+        self.assertEqual(len(cs.flatten(stored)), len(cs.flatten(cs.empty_message(self.shape))))
+        restored = self.reattached(message)
+        # past the end of the chunk the words were taken from
+        self.assert_same_pops(message, restored, chunk_words // 2)
+
+    def test_reattach_after_push(self):
+        message, _ = self.pop(virtual_message(self.seed, self.shape, self.limit), 10)
+        for i in range(20):
+            message = self.codec.push(message, np.full(self.shape, i))
+        restored = self.reattached(message)
+        self.assert_same_pops(message, restored, 30)
+
+    def test_limit(self):
+        message = virtual_message(self.seed, self.shape, limit=16)
+        with self.assertRaises(ValueError):
+            self.pop(message, 100)
+
+
+if __name__ == '__main__':
+    unittest.main()